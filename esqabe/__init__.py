@@ -18,6 +18,6 @@
 # Please cite the paper if you are using this source code.
 # ---------------------------------------------------------------
 
-from .esqabe import esqabe
+from .esqabe import esqabe, esqabe_live, esqabe_sessions
 
-__all__ = ['esqabe']
\ No newline at end of file
+__all__ = ['esqabe', 'esqabe_live', 'esqabe_sessions']
\ No newline at end of file
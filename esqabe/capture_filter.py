@@ -0,0 +1,103 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+from enum import Enum
+import math
+
+
+class PortDirection(Enum):
+    SRC = 'src'
+    DST = 'dst'
+    ANY = 'any'
+
+
+class CaptureFilter:
+    """
+    Declarative requirements of a TraceDecoder consumer. The decoder checks them on the raw header fields,
+    before any address string, TLS or DNS object is built. Times are in milliseconds, like frame_time.
+    """
+    def __init__(self, protocols=None, ports=None, direction=PortDirection.ANY, min_payload_length=0,
+                 min_ip_length=0, min_time=None, max_time=None):
+        self.protocols = None if protocols is None else frozenset(protocols)
+        self.ports = None if ports is None else frozenset(ports)
+        self.direction = direction
+        self.min_payload_length = min_payload_length
+        self.min_ip_length = min_ip_length
+        self.min_time = -math.inf if min_time is None else min_time
+        self.max_time = math.inf if max_time is None else max_time
+
+    def matches_time(self, frame_time):
+        return self.min_time <= frame_time <= self.max_time
+
+    def matches(self, frame_time, protocol, src_port, dst_port, ip_length, payload_length):
+        if self.protocols is not None and protocol not in self.protocols:
+            return False
+
+        if payload_length < self.min_payload_length or ip_length < self.min_ip_length:
+            return False
+
+        if self.ports is not None:
+            if self.direction == PortDirection.SRC:
+                port_match = src_port in self.ports
+            elif self.direction == PortDirection.DST:
+                port_match = dst_port in self.ports
+            else:
+                port_match = src_port in self.ports or dst_port in self.ports
+
+            if not port_match:
+                return False
+
+        return self.matches_time(frame_time)
+
+    def matches_packet(self, packet):
+        return self.matches(packet.frame_time, packet.protocol, packet.src_port, packet.dst_port, packet.ip_length,
+                            packet.payload_length)
+
+
+class FilterSet:
+    """
+    The capture filters of all consumers of a decoder. A consumer without capture_filters receives every packet.
+    """
+    def __init__(self, consumers):
+        self.routes = [(consumer, getattr(consumer, 'capture_filters', None)) for consumer in consumers]
+        self.accept_all = any(filters is None for consumer, filters in self.routes)
+
+        if self.accept_all:
+            self.filters = None
+            self.min_time, self.max_time = -math.inf, math.inf
+        else:
+            self.filters = [f for consumer, consumer_filters in self.routes for f in consumer_filters]
+            self.min_time = min((f.min_time for f in self.filters), default=math.inf)
+            self.max_time = max((f.max_time for f in self.filters), default=-math.inf)
+
+    def matches_time(self, frame_time):
+        return self.min_time <= frame_time <= self.max_time
+
+    def matches(self, frame_time, protocol, src_port, dst_port, ip_length, payload_length):
+        if self.accept_all:
+            return True
+
+        return any(f.matches(frame_time, protocol, src_port, dst_port, ip_length, payload_length)
+                   for f in self.filters)
+
+    def consumers_for(self, packet):
+        for consumer, filters in self.routes:
+            if filters is None or any(f.matches_packet(packet) for f in filters):
+                yield consumer
@@ -0,0 +1,137 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import gzip
+import lzma
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+READ_BLOCK_SIZE = 1 << 20
+# Decompressed blocks buffered ahead of the decoder, bounds the memory of the background thread
+QUEUE_BLOCKS = 16
+
+
+def compression_of(pcap):
+    """
+    Returns 'gzip', 'xz', 'zstd' or None, based on the magic bytes at the start of the file
+    """
+    with open(pcap, 'rb') as f:
+        magic = f.read(6)
+
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    elif magic.startswith(XZ_MAGIC):
+        return 'xz'
+    elif magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def open_trace(pcap):
+    """
+    Opens a trace for sequential reading. Compressed traces are decompressed on the fly in a background thread,
+    plain traces are opened as a normal (seekable) file.
+    """
+    compression = compression_of(pcap)
+    if compression == 'gzip':
+        return BackgroundReader(gzip.open(pcap, 'rb'))
+    elif compression == 'xz':
+        return BackgroundReader(lzma.open(pcap, 'rb'))
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('{} is zstd compressed, install the zstandard package to read it'.format(pcap))
+        return BackgroundReader(zstandard.ZstdDecompressor().stream_reader(open(pcap, 'rb'), closefd=True))
+    return open(pcap, 'rb')
+
+
+class BackgroundReader:
+    """
+    Read-only, non-seekable file object reading another stream in a background thread, so decompression
+    overlaps with the decoding of the packets. At most QUEUE_BLOCKS blocks are buffered.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.buffer = b''
+        self.offset = 0
+        self.eof = False
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.__fill, daemon=True)
+        self.thread.start()
+
+    def __fill(self):
+        try:
+            while not self.closed.is_set():
+                block = self.stream.read(READ_BLOCK_SIZE)
+                self.__put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.__put(e)
+
+    def __put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __next_block(self):
+        block = self.blocks.get()
+        if isinstance(block, Exception):
+            self.eof = True
+            raise block
+        if not block:
+            self.eof = True
+        return block
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.offset < size):
+            self.buffer = self.buffer[self.offset:] + self.__next_block()
+            self.offset = 0
+
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset += len(data)
+        return data
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.closed.set()
+        self.thread.join()
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
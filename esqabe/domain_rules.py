@@ -0,0 +1,151 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import collections
+
+RULE_KINDS = ('substring', 'suffix', 'exact')
+# Domains remembered per DomainRules, the memo is cleared when it grows beyond this
+MEMO_SIZE = 1 << 16
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton telling whether a text contains any of the patterns, in a single pass over the text
+    """
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [False]
+        for pattern in patterns:
+            self.__add(pattern)
+        self.__link()
+
+    def __add(self, pattern):
+        if len(pattern) == 0:
+            return
+
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(False)
+            state = next_state
+        self.output[state] = True
+
+    def __link(self):
+        queue = collections.deque(self.goto[0].values())
+        while len(queue) > 0:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail > 0 and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+                queue.append(next_state)
+
+    def search(self, text):
+        state = 0
+        for char in text:
+            while state > 0 and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                return True
+        return False
+
+
+class SuffixTrie:
+    """
+    Trie of domains on their reversed labels, a domain matches when it is one of the domains or a subdomain of one
+    """
+    def __init__(self, domains):
+        self.root = {}
+        for domain in domains:
+            node = self.root
+            for label in reversed(domain.split('.')):
+                node = node.setdefault(label, {})
+            node[None] = True
+
+    def matches(self, domain):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class DomainRules:
+    """
+    Set of domain rules: substrings anywhere in the domain, suffixes matching a domain and its subdomains and exact
+    domains. The substrings are compiled into an AhoCorasick automaton and the suffixes into a SuffixTrie, so a
+    check does not depend on the number of rules. Results are memoized per domain.
+    """
+    def __init__(self, substrings=(), suffixes=(), exact=()):
+        self.substrings = AhoCorasick(substrings)
+        self.suffixes = SuffixTrie(suffixes)
+        self.exact = frozenset(exact)
+        self.memo = {}
+
+    def matches(self, domain):
+        result = self.memo.get(domain)
+        if result is None:
+            result = domain in self.exact or self.suffixes.matches(domain) or self.substrings.search(domain)
+            if len(self.memo) >= MEMO_SIZE:
+                self.memo.clear()
+            self.memo[domain] = result
+        return result
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Loads a rules file with one `kind:value` rule per line, kind is substring, suffix or exact and # starts a
+        comment. Values are matched lower case.
+        """
+        rules = {kind: [] for kind in RULE_KINDS}
+        with open(path) as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.split('#', 1)[0].strip()
+                if len(line) == 0:
+                    continue
+
+                kind, separator, value = line.partition(':')
+                if separator == '' or kind.strip() not in rules:
+                    raise ValueError('invalid domain rule in {} line {}: {}'.format(path, line_number, line))
+                rules[kind.strip()].append(value.strip().lower())
+
+        return cls(rules['substring'], rules['suffix'], rules['exact'])
+
+
+# DomainRules per rules file, shared by everything in the process using that file
+LOADED_RULES = {}
+
+
+def load_domain_rules(path):
+    if path not in LOADED_RULES:
+        LOADED_RULES[path] = DomainRules.from_file(path)
+    return LOADED_RULES[path]
@@ -18,20 +18,39 @@
 # Please cite the paper if you are using this source code.
 # ---------------------------------------------------------------
 
-from .kreep import mini_kreep
-from .search_trace import SearchTrace
-from .website_visit import WebsiteVisit
+from .kreep import mini_kreep, search_sessions, KeystrokeLoader, LiveKreep
+from .search_trace import SearchTrace, AVOIDED_DOMAINS
+from .trace_decoder import TraceDecoder
+from .reverse_dns import ReverseDNSResolver
+from .passive_dns import PassiveDNSStore
+from .website_visit import BrowserPool, BROWSER_POOL_SIZE, VISIT_TIMEOUT
 from .wiki_fingerprint_comparer import WikiFingerprintComparer
 from .utils import unify_case_in_counter, counter_threshold
 from .esqabe_result import ESQABEResult
 import collections
+import sys
 
 
-def esqabe(pcapng):
+def esqabe(pcapng, cache_dir=None, workers=1, use_index=False, memory_budget=None, reverse_dns=False,
+           passive_dns=None, avoided_domains=AVOIDED_DOMAINS, browsers=BROWSER_POOL_SIZE, visit_timeout=VISIT_TIMEOUT):
     result = ESQABEResult()
+    # Budget in MB, the packets of the trace are spilled to disk beyond it
+    memory_budget = None if memory_budget is None else memory_budget * 1024 * 1024
+    # The reverse DNS names are cached next to the decoded traces
+    reverse_dns = reverse_dns and ReverseDNSResolver.for_cache_dir(cache_dir)
+    # IP to domain mappings of all analysed traces
+    passive_dns = None if passive_dns is None else PassiveDNSStore(passive_dns)
+
+    # STEP 1 and 2 share a single decoding pass over the trace. With the index STEP 2 seeks to its window afterwards,
+    # only the DNS answers and SNIs of the whole trace are collected in this pass.
+    keystroke_loader = KeystrokeLoader('google', memory_budget, reverse_dns, passive_dns)
+    trace = SearchTrace(pcapng, memory_budget, passive_dns, avoided_domains)
+    trace.mappings_only = use_index
+    TraceDecoder(pcapng, cache_dir, workers, use_index).add_consumer(keystroke_loader).add_consumer(trace).decode()
 
     print('-- STEP 1: Determine suggestions --')
-    kreep_word_len, latest_package, google_dst, highest_frame, google_packets = mini_kreep(pcapng, 20, 'google')
+    kreep_word_len, latest_package, google_dst, highest_frame, google_packets = \
+        mini_kreep(keystroke_loader, 20, 'google', workers=workers)
     result.pattern = kreep_word_len
 
 
@@ -40,9 +59,11 @@ def esqabe(pcapng):
     print('Google DST:', google_dst)
 
     print('-- STEP 2: Retrieve all domains / ips --')
-    trace = SearchTrace(pcapng)
     trace.set_interesting_minimum_time(latest_package)
-    trace.parse()
+    if use_index:
+        trace.parse(cache_dir, workers, use_index)
+    else:
+        trace.finish_parse()
 
     print('Domains:', trace.get_ip_domain_mapping())
     print('Unkown IPs:', trace.get_unrecognised_ips())
@@ -57,17 +78,17 @@ def esqabe(pcapng):
     print('Pattern:', pattern)
     matches_per_site = {}
     matches_all = collections.Counter()
-    for website_guess in guesses:
-        visit_domain = website_guess[0]
-
-        if WikiFingerprintComparer.is_from_wiki(visit_domain) or 'google' in visit_domain:
+    visit_domains = [website_guess[0] for website_guess in guesses
+                     if not WikiFingerprintComparer.is_from_wiki(website_guess[0]) and 'google' not in website_guess[0]]
+    # The guesses are visited at the same time, one per browser of the pool
+    with BrowserPool(browsers, visit_timeout) as pool:
+        found = pool.visit_all(visit_domains, lambda visit: collections.Counter(visit.find_regex([pattern])))
+
+    for visit_domain, matches in zip(visit_domains, found):
+        if matches is None:
             continue
 
-        visit = WebsiteVisit(visit_domain)
-        visit.start_session()
-        matches = collections.Counter(visit.find_regex([pattern]))
         matches_all.update(matches)
-        visit.end_session()
         if len(matches) > 0:
             print('Found on', visit_domain, ':', matches)
             matches_per_site[visit_domain] = matches
@@ -76,7 +97,7 @@ def esqabe(pcapng):
     print('Found on websites:', matches_all)
 
     print('-- STEP 4: Use Wikipedia Fingerprinting when visited')
-    wiki_comp = WikiFingerprintComparer()
+    wiki_comp = WikiFingerprintComparer(passive_dns)
     wiki_comp.feed_with_ip_domains(trace.get_ip_domain_mapping())
     for website_guess in guesses:
         visit_domain = website_guess[0]
@@ -90,7 +111,7 @@ def esqabe(pcapng):
         if len(matches_all) <= 0:
             break
 
-        wiki_term, wiki_url = wiki_comp.compare(list(list(zip(*matches_all.most_common(3)))[0]), trace.get_packets_df(), website_guess[1])
+        wiki_term, wiki_url = wiki_comp.compare(list(list(zip(*matches_all.most_common(3)))[0]), trace.get_packets_df(website_guess[1]), website_guess[1])
         print('Visited WikiPage was probably', wiki_url)
         result.guessed_wiki = wiki_url
         if wiki_url is not None:
@@ -103,6 +124,55 @@ def esqabe(pcapng):
     return result
 
 
+def esqabe_sessions(pcapng, cache_dir=None, workers=1, use_index=False, memory_budget=None, reverse_dns=False,
+                    passive_dns=None, avoided_domains=AVOIDED_DOMAINS):
+    """
+    STEP 1 and 2 for every search in the trace: prints the word lengths, the time window and the website guesses of
+    every search session
+    """
+    memory_budget = None if memory_budget is None else memory_budget * 1024 * 1024
+    reverse_dns = reverse_dns and ReverseDNSResolver.for_cache_dir(cache_dir)
+    passive_dns = None if passive_dns is None else PassiveDNSStore(passive_dns)
+    keystroke_loader = KeystrokeLoader('google', memory_budget, reverse_dns, passive_dns)
+    trace = SearchTrace(pcapng, memory_budget, passive_dns, avoided_domains)
+    TraceDecoder(pcapng, cache_dir, workers, use_index).add_consumer(keystroke_loader).add_consumer(trace).decode()
+
+    sessions = search_sessions(keystroke_loader, 20, 'google', workers=workers)
+    if len(sessions) > 0:
+        trace.set_interesting_minimum_time(sessions[0].end_time)
+    trace.finish_parse()
+
+    results = []
+    for i, session in enumerate(sessions):
+        # The visits of a search happen between its last keystroke and the next search
+        next_start = sessions[i + 1].start_time if i + 1 < len(sessions) else None
+        guesses = trace.make_website_guess(session.end_time, next_start)
+        print('Search', i + 1, 'from', session.start_time / 1000, 'to', session.end_time / 1000)
+        print('  Mini-Kreep:', session.word_lengths, 'Pattern:', generate_pattern(session.word_lengths))
+        print('  Guesses:', guesses)
+        results.append((session, guesses))
+
+    return results
+
+
+def esqabe_live(pcapng, reverse_dns=False, passive_dns=None):
+    """
+    Follows a pcapng stream that is still being captured ('-' for stdin or a named pipe) and prints the word lengths
+    and search pattern every time new keystrokes are detected
+    """
+    def print_update(kreep_word_len, keystrokes):
+        print('Mini-Kreep:', kreep_word_len, 'Latest Timestamp:', keystrokes['frame_time'].max() / 1000,
+              'Pattern:', generate_pattern(kreep_word_len), flush=True)
+
+    live = LiveKreep('google', 20, print_update, reverse_dns=reverse_dns,
+                     passive_dns=None if passive_dns is None else PassiveDNSStore(passive_dns))
+    if pcapng == '-':
+        live.run(sys.stdin.buffer)
+    else:
+        with open(pcapng, 'rb') as f:
+            live.run(f)
+
+
 def generate_pattern(kreep_word_len):
     resulting_regex = ""
 
@@ -0,0 +1,131 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import dpkt
+from .utils import inet_to_str
+from .capture_filter import CaptureFilter, PortDirection
+
+DNS_PORT = 53
+HTTPS_PORT = 443
+TLS_HANDSHAKE = 22
+TLS_CLIENT_HELLO = 1
+TLS_EXTENSION_SNI = 0
+# Longest CNAME chain followed back from an address record
+MAX_CNAME_CHAIN = 16
+
+
+def client_hello_sni(payload):
+    """
+    Returns the lower case server name of a TLS client hello, None when the payload holds none
+    """
+    if len(payload) == 0 or payload[0] != TLS_HANDSHAKE:
+        return None
+
+    try:
+        tls_records, i = dpkt.ssl.tls_multi_factory(payload)
+    except (dpkt.ssl.SSL3Exception, dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+        return None
+
+    for record in tls_records:
+        if record.type == TLS_HANDSHAKE:
+            try:
+                tls_handshake = dpkt.ssl.TLSHandshake(record.data)
+            except (dpkt.ssl.SSL3Exception, dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+                return None
+
+            if tls_handshake.type == TLS_CLIENT_HELLO and hasattr(tls_handshake.data, 'extensions'):
+                for tls_extension in tls_handshake.data.extensions:
+                    if tls_extension[0] == TLS_EXTENSION_SNI:
+                        return str.lower(tls_extension[1][5:].decode('ascii', 'ignore'))
+    return None
+
+
+def dns_address_names(payload):
+    """
+    Returns (ip, name) of every A/AAAA answer of a DNS response, for every name of the CNAME chain that led to it
+    """
+    try:
+        dns = dpkt.dns.DNS(payload)
+    except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
+        return []
+
+    # Canonical name -> aliases pointing to it
+    aliases = {}
+    for answer in dns.an:
+        if answer.type == dpkt.dns.DNS_CNAME:
+            aliases.setdefault(str.lower(answer.cname), []).append(str.lower(answer.name))
+
+    results = []
+    for answer in dns.an:
+        if answer.type == dpkt.dns.DNS_A:
+            ip = inet_to_str(answer.ip)
+        elif answer.type == dpkt.dns.DNS_AAAA:
+            ip = inet_to_str(answer.ip6)
+        else:
+            continue
+
+        names = [str.lower(answer.name)]
+        seen = set(names)
+        i = 0
+        while i < len(names) and len(names) <= MAX_CNAME_CHAIN:
+            for alias in aliases.get(names[i], []):
+                if alias not in seen:
+                    seen.add(alias)
+                    names.append(alias)
+            i += 1
+        results.extend((ip, name) for name in names)
+    return results
+
+
+class HostEvidence:
+    """
+    Host names of IPs as the trace itself tells them: the SNI of TLS client hellos and the A/AAAA answers of DNS
+    responses, including every alias of their CNAME chain. It is fed with the packets while they are decoded, so
+    the names of a connection are known from the lookup or handshake that precedes it.
+    """
+    capture_filters = [
+        CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], ports=[HTTPS_PORT], direction=PortDirection.DST,
+                      min_payload_length=1),
+        CaptureFilter(protocols=[dpkt.ip.IP_PROTO_UDP], ports=[DNS_PORT], direction=PortDirection.SRC)
+    ]
+
+    def __init__(self):
+        self.hostnames = {}
+
+    def handle_packet(self, packet):
+        """
+        Returns the IPs that got a new host name from the packet
+        """
+        if packet.protocol == dpkt.ip.IP_PROTO_TCP and packet.dst_port == HTTPS_PORT:
+            name = client_hello_sni(packet.payload) if packet.payload_length > 0 else None
+            return [] if name is None else self.add(packet.dst_ip, name)
+        elif packet.protocol == dpkt.ip.IP_PROTO_UDP and packet.src_port == DNS_PORT:
+            return [ip for ip, name in dns_address_names(packet.payload) if len(self.add(ip, name)) > 0]
+        return []
+
+    def add(self, ip, name):
+        names = self.hostnames.setdefault(ip, set())
+        if name in names:
+            return []
+        names.add(name)
+        return [ip]
+
+    def names(self, ip):
+        return self.hostnames.get(ip, ())
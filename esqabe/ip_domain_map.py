@@ -0,0 +1,90 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+class IPDomainMap:
+    """
+    Many to many mapping of IPs and domains, indexed in both directions. Iterating it yields (ip, domain) pairs,
+    like the sets of pairs it replaces.
+    """
+    def __init__(self, pairs=()):
+        self.domains_by_ip = {}
+        self.ips_by_domain = {}
+        self.update(pairs)
+
+    def __iter__(self):
+        for ip, domains in self.domains_by_ip.items():
+            for domain in domains:
+                yield ip, domain
+
+    def __len__(self):
+        return sum(len(domains) for domains in self.domains_by_ip.values())
+
+    def __contains__(self, ip_domain):
+        return ip_domain[1] in self.domains_by_ip.get(ip_domain[0], ())
+
+    def __repr__(self):
+        return 'IPDomainMap({})'.format(sorted(self))
+
+    def add(self, ip, domain):
+        self.domains_by_ip.setdefault(ip, set()).add(domain)
+        self.ips_by_domain.setdefault(domain, set()).add(ip)
+
+    def update(self, pairs):
+        for ip, domain in pairs:
+            self.add(ip, domain)
+
+    def domains(self, ip):
+        return self.domains_by_ip.get(ip, set())
+
+    def ips(self, domain):
+        return self.ips_by_domain.get(domain, set())
+
+    def domain_of(self, ip):
+        """
+        One of the domains of the ip, None when it has none
+        """
+        return next(iter(self.domains(ip)), None)
+
+    def ip_set(self):
+        return self.domains_by_ip.keys()
+
+    def domain_set(self):
+        return self.ips_by_domain.keys()
+
+    def restrict_ips(self, ips):
+        """
+        New map with only the pairs of the given ips
+        """
+        result = IPDomainMap()
+        for ip in self.domains_by_ip.keys() & ips:
+            for domain in self.domains_by_ip[ip]:
+                result.add(ip, domain)
+        return result
+
+    def filter_domains(self, predicate):
+        """
+        New map with only the pairs of domains for which predicate(domain) holds, evaluated once per domain
+        """
+        result = IPDomainMap()
+        for domain, ips in self.ips_by_domain.items():
+            if predicate(domain):
+                for ip in ips:
+                    result.add(ip, domain)
+        return result
@@ -0,0 +1,91 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import ipaddress
+
+# Children and value of a trie node
+ZERO = 0
+ONE = 1
+VALUE = 2
+
+
+class PrefixTrie:
+    """
+    Binary trie of IPv4 and IPv6 prefixes, one node per prefix bit. A lookup walks one node per bit of the address
+    until the path has no child for the next bit, so its cost is bounded by the longest stored prefix instead of the
+    number of prefixes.
+    """
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, ip):
+        return self.lookup(ip) is not None
+
+    def add(self, prefix, value=True):
+        network = ipaddress.ip_network(prefix, strict=False)
+        bits = int(network.network_address)
+        width = network.max_prefixlen
+        node = self.roots[network.version]
+        for i in range(width - 1, width - 1 - network.prefixlen, -1):
+            bit = (bits >> i) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[VALUE] is None:
+            self.size += 1
+        node[VALUE] = value
+
+    def lookup(self, ip):
+        """
+        Returns the value of the longest prefix holding the address, None when no prefix holds it or it is no address
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+
+        bits = int(address)
+        node = self.roots[address.version]
+        match = node[VALUE]
+        for i in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(bits >> i) & 1]
+            if node is None:
+                break
+            if node[VALUE] is not None:
+                match = node[VALUE]
+        return match
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Loads a prefix file: one IPv4 or IPv6 prefix in CIDR notation per line, # starts a comment
+        """
+        trie = cls()
+        with open(path) as f:
+            for line in f:
+                prefix = line.split('#', 1)[0].strip()
+                if len(prefix) > 0:
+                    trie.add(prefix)
+        return trie
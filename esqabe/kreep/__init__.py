@@ -1,3 +1,5 @@
-from .kreep import mini_kreep
+from .kreep import mini_kreep, search_sessions, SearchSession
+from .util import KeystrokeLoader
+from .live import LiveKreep
 
-__all__ = ['mini_kreep']
+__all__ = ['mini_kreep', 'search_sessions', 'SearchSession', 'KeystrokeLoader', 'LiveKreep']
@@ -12,122 +12,351 @@
 #   - Reduced version of Kreep, only detection and tokenization
 # ----------------------------------------------------------------
 
+from concurrent.futures import ProcessPoolExecutor
+from ..shared_columns import SharedColumns
+import bisect
 import numpy as np
 import math
+import os
 
+# At least the min size of a GET request
+MIN_GET_LENGTH = 100
+# Bucket size (ms) in which the incoming traffic is summed to find network spikes
+SPIKE_BUCKET_SIZE = 500
+# Batches of sequences handed to every worker of a SequenceSearch, to even out flows of different length
+BATCHES_PER_WORKER = 4
+# Fewer packets than this are searched serially, a process pool takes longer to start than the search itself
+PARALLEL_MIN_PACKETS = 20000
 
-def google_rule(a, e, ta, te, tp):
-    d = e - a[-1]
 
-    if len(a) <= 2 and te - ta > 2500:
-        return False
+# Increase of the frame length that counts as a jump in the chain state
+JUMP_DELTA = 4
+# Jump target of sequences that can not jump anymore, far from any difference
+NO_JUMP = -(1 << 40)
 
-    if te - tp > 3000:
-        return False
 
-    # Only one decrease allowed, only possible if gs_mss appeard already
-    # Dont know why decreases are allowed, so temp turned this of
-    if False and d < 0:
-        pd = np.diff(a)
-        return len(a) >= 5 and (pd < 0).sum() <= 0 and (pd >= 4).sum() >= 1
-
-    # No consecutive 0s
-    if d == 0:
-        return 0 not in np.diff(a[-2:])
-
-    if d == 1:
-        return True
-
-    if d == 2:
-        return True
-
-    if d == 3:
-        return True
-
-    # Bigger increase is okay, if not to big!
-    # Made bigger increase more exact, because of known gs_mss behaviour
-    # if 25 > d >= 4:
-    estimated_gsmssd = (a[-1] - a[0]) + 8 + 1
-    if d > 4 and estimated_gsmssd + 5 > d > estimated_gsmssd - 5:
-        pd = np.diff(a)
-        return len(a) >= 5 and (pd >= 4).sum() <= 0
-
-    return False
+class DetectionRule:
+    '''
+    Declarative keystroke rule. A sequence whose last element has length `last` at time `ta` accepts an element
+    of length e at time te when:
+      - te - ta <= max_gap, and te - ta <= short_max_gap while the sequence has at most short_length elements
+      - and d = e - last is one of deltas, or is 0 while the previous difference was not 0 (allow_repeat), or is a
+        jump (d > JUMP_DELTA) to within jump_tolerance of the difference last - first + jump_offset, for sequences
+        of at least jump_min_length elements without an earlier jump
+    The rule is compiled into a few values per sequence (see ChainState) which are checked for all candidate
+    sequences at once.
+    '''
+    def __init__(self, deltas=range(0), max_gap=None, short_length=2, short_max_gap=None, allow_repeat=False,
+                 jump_offset=None, jump_tolerance=5, jump_min_length=5):
+        self.min_delta = deltas.start
+        self.max_delta = deltas.stop - 1
+        self.max_gap = max_gap
+        self.short_length = short_length
+        self.short_max_gap = short_max_gap
+        self.allow_repeat = allow_repeat
+        self.jump_offset = jump_offset
+        self.jump_tolerance = jump_tolerance
+        self.jump_min_length = jump_min_length
+
+    def gap_limit(self, length):
+        limit = math.inf if self.max_gap is None else self.max_gap
+        if self.short_max_gap is not None and length <= self.short_length:
+            limit = min(limit, self.short_max_gap)
+        return limit
+
+    def jump_target(self, first, last, length, jumps):
+        if self.jump_offset is None or length < self.jump_min_length or jumps > 0:
+            return NO_JUMP
+        return last - first + self.jump_offset
+
+    def accepts(self, state, lo, hi, e, te):
+        '''
+        Boolean mask of the sequences lo..hi-1 of the ChainState that accept element e at time te
+        '''
+        d = e - state.last[lo:hi]
+        accept = (d >= self.min_delta) & (d <= self.max_delta)
+
+        if self.allow_repeat:
+            # No consecutive 0s
+            accept |= (d == 0) & state.zero_allowed[lo:hi]
+
+        if self.jump_offset is not None:
+            # Bigger increase is okay, if not to big, it is the known gs_mss behaviour
+            accept |= (d > JUMP_DELTA) & (np.abs(d - state.jump_target[lo:hi]) < self.jump_tolerance)
+
+        return accept & (te - state.time[lo:hi] <= state.gap_limit[lo:hi])
+
+
+# Google: +1..3 per keystroke at most 3 s apart (2.5 s while the sequence has at most 2 elements), no consecutive
+# 0s, and once, after at least 5 elements, a jump of the growth so far + 9 (within 5) when gs_mss appears.
+# Baidu: +2..30 per keystroke, without a gap limit apart from 2 s while the sequence has at most 2 elements.
+google_rule = DetectionRule(deltas=range(1, 4), max_gap=3000, short_max_gap=2500, allow_repeat=True, jump_offset=9)
+baidu_rule = DetectionRule(deltas=range(2, 31), short_max_gap=2000)
 
+DETECTION_RULES = {
+    'google': google_rule,
+    'baidu': baidu_rule
+}
 
-def baidu_rule(a, e, ta, te, tp):
-    d = e - a[-1]
 
-    if len(a) <= 2 and te - ta > 2000:
-        return False
+class ChainState:
+    '''
+    State of the longest accepted sequence ending at every element, updated incrementally: the first and last
+    length, the time of the last element, the length of the sequence, the number of jumps and the last difference
+    (inf for a single element). Also the values the rule compiles to: the largest gap to a next element, whether a
+    0 difference may follow and the expected jump difference.
+    '''
+    COLUMNS = ('first', 'last', 'time', 'length', 'jumps', 'last_diff', 'gap_limit', 'zero_allowed', 'jump_target')
+
+    def __init__(self, n, rule):
+        self.rule = rule
+        self.first = np.zeros(n, dtype=np.int64)
+        self.last = np.zeros(n, dtype=np.int64)
+        self.time = np.zeros(n, dtype=np.float64)
+        self.length = np.zeros(n, dtype=np.int64)
+        self.jumps = np.zeros(n, dtype=np.int64)
+        self.last_diff = np.full(n, math.inf)
+        self.gap_limit = np.zeros(n, dtype=np.float64)
+        self.zero_allowed = np.zeros(n, dtype=bool)
+        self.jump_target = np.full(n, NO_JUMP, dtype=np.int64)
+
+    def grow(self, n):
+        '''
+        Room for n elements, the state of the current ones is kept
+        '''
+        for name in self.COLUMNS:
+            values = getattr(self, name)
+            grown = np.empty(n, dtype=values.dtype)
+            grown[:len(values)] = values
+            setattr(self, name, grown)
+
+    def move(self, start, stop):
+        '''
+        Moves the state of the elements start..stop-1 to the front
+        '''
+        for name in self.COLUMNS:
+            values = getattr(self, name)
+            values[:stop - start] = values[start:stop].copy()
+
+    def row(self, i):
+        return tuple(getattr(self, name)[i] for name in self.COLUMNS)
+
+    def start(self, i, e, te):
+        self.__set(i, e, e, te, 1, 0, math.inf)
+
+    def extend(self, i, j, e, te):
+        d = e - self.last[j]
+        self.__set(i, self.first[j], e, te, self.length[j] + 1, self.jumps[j] + (d >= JUMP_DELTA), d)
+
+    def __set(self, i, first, last, te, length, jumps, last_diff):
+        self.first[i] = first
+        self.last[i] = last
+        self.time[i] = te
+        self.length[i] = length
+        self.jumps[i] = jumps
+        self.last_diff[i] = last_diff
+        self.gap_limit[i] = self.rule.gap_limit(length)
+        self.zero_allowed[i] = last_diff != 0
+        self.jump_target[i] = self.rule.jump_target(first, last, length, jumps)
+
+
+def longest_dfa_sequence(a, t, rule):
+    '''
+    Find the longest subsequence accepted by a DFA, see DFASequence
+    '''
+    sequence = DFASequence(rule, len(a))
+    for e, te in zip(a, t):
+        sequence.append(e, te)
+    return sequence.longest()
 
-    if d >= 2 and d <= 30:
-        return True
 
-    return False
+class DFASequence:
+    '''
+    Longest subsequence accepted by a DFA of elements added one at a time. The DetectionRule is checked for all
+    earlier elements at once, on the state of the longest sequence ending there, so an added element never changes
+    the state of the earlier ones. Only a predecessor per element is kept, the sequence is rebuilt by longest().
+    With a max_gap and sorted times, only the elements at most max_gap earlier are tried as predecessor.
+    '''
+    def __init__(self, rule, capacity=16):
+        self.rule = rule
+        self.t = []
+        # The elements before start are dropped
+        self.start = 0
+        self.state = ChainState(max(capacity, 1), rule)
+        self.pred = np.full(max(capacity, 1), -1, dtype=np.int64)
+        self.bounded = rule.max_gap is not None
+
+    def __len__(self):
+        return len(self.t) - self.start
+
+    def append(self, e, te):
+        i = len(self.t)
+        if i == len(self.pred):
+            self.state.grow(2 * i)
+            self.pred = np.concatenate([self.pred, np.full(i, -1, dtype=np.int64)])
+        self.bounded = self.bounded and (i == 0 or self.t[-1] <= te)
+        self.t.append(te)
+        self.__search(i, e, te)
+
+    def drop(self, count):
+        '''
+        Drops the first count elements. The states that depended on them are searched again, with a max_gap and
+        sorted times only until no element within max_gap before the next one changed.
+        '''
+        self.start += count
+        last_changed = self.start - 1
+        for i in range(self.start, len(self.t)):
+            te = self.t[i]
+            if self.bounded and self.t[last_changed] < te - self.rule.max_gap - 1:
+                break
+            before = self.state.row(i) + (self.pred[i],)
+            self.__search(i, int(self.state.last[i]), te)
+            if self.state.row(i) + (self.pred[i],) != before:
+                last_changed = i
+
+        if self.start > len(self.t) // 2:
+            n = len(self.t) - self.start
+            self.state.move(self.start, len(self.t))
+            pred = self.pred[self.start:len(self.t)]
+            self.pred[:n] = np.where(pred >= 0, pred - self.start, -1)
+            del self.t[:self.start]
+            self.start = 0
+
+    def __search(self, i, e, te):
+        # One ms slack, the rule itself still decides on the exact gap
+        lo = bisect.bisect_left(self.t, te - self.rule.max_gap - 1, self.start, i) if self.bounded else self.start
+        lengths = np.where(self.rule.accepts(self.state, lo, i, e, te), self.state.length[lo:i], 0)
+        longest = lengths.max() if i > lo else 0
+        if longest == 0:
+            self.state.start(i, e, te)
+            self.pred[i] = -1
+        else:
+            # Of the accepted sequences with the maximal length, the last one wins
+            j = lo + len(lengths) - 1 - int(np.argmax(lengths[::-1] == longest))
+            self.state.extend(i, j, e, te)
+            self.pred[i] = j
+
+    def longest(self):
+        '''
+        Indices of the longest accepted subsequence of the (remaining) elements
+        '''
+        if len(self) == 0:
+            return []
 
+        # Added extra rule which chooses the longest opportunity with the best match
+        length = self.state.length[self.start:len(self.t)]
+        longest = self.start + np.flatnonzero(length == length.max())
+        m = int(longest[np.argmin(self.state.last_diff[longest])])
 
-DETECTION_RULES = {
-    'google': google_rule,
-    'baidu': baidu_rule
-}
+        idx = []
+        while m >= 0:
+            idx.append(m - self.start)
+            m = int(self.pred[m])
+        return idx[::-1]
 
 
-def longest_dfa_sequence(a, t, append_rule):
+def split_flows(df):
     '''
-    Find the longest subsequence accepted by a DFA. append_rule returns True or
-    False to indicate whether the DFA that accepted sequence a can transition
-    after appending element t
+    Split the packets into their (src, dst, protocol) flows in a single pass, in order of first appearance.
+    Returns a list of (flow DataFrame, frame lengths, frame times), shared by all detection rules
     '''
-    n = len(a)
-    L = [[] for _ in range(n)]
-    idx = [[] for _ in range(n)]
-
-    L[0].append(a[0])
-    idx[0].append(0)
+    # At least the min size of a GET request
+    df = df[df['frame_length'] > MIN_GET_LENGTH]
 
-    for i in range(1, n):
-        for j in range(i):
-            if append_rule(L[j], a[i], t[j], t[i], t[idx[j][-1]]) and len(L[i]) < len(L[j]) + 1:
-                L[i] = L[j].copy()
-                idx[i] = idx[j].copy()
+    return [(df_dst, df_dst['frame_length'].values.tolist(), df_dst['frame_time'].values.tolist())
+            for flow, df_dst in df.groupby(['src', 'dst', 'protocol'], sort=False)]
 
-        L[i].append(a[i])
-        idx[i].append(i)
 
-    m = idx[0]
-    if len(m) > 1:
-        pdiff = L[0][-1] - L[0][-2]
-    else:
-        pdiff = math.inf
+class SequenceSearch:
+    '''
+    The (frame lengths, frame times) pairs of a stage, searched by one or more detection rules.
+    With more than one worker (at most one per CPU) and at least PARALLEL_MIN_PACKETS packets, the pairs are published
+    once in shared memory and a single process pool runs every rule on batches of them, reading read-only views
+    instead of pickled copies. Both are created on the first parallel search and removed on close(), or when used as
+    context manager.
+    '''
+    def __init__(self, sequences, workers=1):
+        self.sequences = sequences
+        self.bounds = np.cumsum([0] + [len(frame_lengths) for frame_lengths, frame_times in sequences])
+        self.workers = min(workers, os.cpu_count() or 1)
+        if len(sequences) < 2 or self.bounds[-1] < PARALLEL_MIN_PACKETS:
+            self.workers = 1
+        self.shared = None
+        self.pool = None
+
+    def longest(self, website):
+        '''
+        Longest sequence accepted by the rule of the website in every pair
+        '''
+        if self.workers <= 1:
+            return [longest_dfa_sequence(frame_lengths, frame_times, DETECTION_RULES[website])
+                    for frame_lengths, frame_times in self.sequences]
+
+        if self.pool is None:
+            self.shared = SharedColumns.publish({
+                'frame_length': np.concatenate([np.asarray(frame_lengths, dtype=np.int64)
+                                                for frame_lengths, frame_times in self.sequences]),
+                'frame_time': np.concatenate([np.asarray(frame_times, dtype=np.float64)
+                                              for frame_lengths, frame_times in self.sequences])})
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        batches = np.array_split(np.arange(len(self.sequences)),
+                                 min(len(self.sequences), self.workers * BATCHES_PER_WORKER))
+        futures = [self.pool.submit(shared_sequences, self.shared, website, self.bounds[batch[0]:batch[-1] + 2])
+                   for batch in batches]
+        return [idx for future in futures for idx in future.result()]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.shared.close()
+            self.pool = None
+            self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def longest_sequences(sequences, website, workers=1):
+    '''
+    Longest sequence accepted by the rule of the website in every (frame lengths, frame times) pair, see
+    SequenceSearch
+    '''
+    with SequenceSearch(sequences, workers) as search:
+        return search.longest(website)
 
-    for i in range(len(idx)):
-        # Added extra rule which chooses the longest opportunity with the best match
-        x = idx[i]
-        if len(x) > 1:
-            diff = L[i][-1] - L[i][-2]
-        else:
-            diff = math.inf
-        if len(x) > len(m) or (len(x) == len(m) and diff < pdiff):
-            m = x
-            pdiff = diff
 
-    return m
+def shared_sequences(shared, website, bounds):
+    '''
+    Worker of SequenceSearch, for the sequences between consecutive bounds of the SharedColumns
+    '''
+    frame_lengths, frame_times = shared['frame_length'], shared['frame_time']
+    return [longest_dfa_sequence(frame_lengths[start:end].tolist(), frame_times[start:end].tolist(),
+                                 DETECTION_RULES[website])
+            for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
 
 
-def detect_keystrokes(df, website):
-    # At least the min size of a GET request
-    df = df[df['frame_length'] > 100]
+def detect_keystrokes(df, website, flows=None, workers=1, search=None):
+    if flows is None:
+        flows = split_flows(df)
 
     result = []
-    for src, dst, protocol in df[['src', 'dst', 'protocol']].drop_duplicates().values:
-        df_dst = df[(df['src'] == src) & (df['dst'] == dst) & (df['protocol'] == protocol)]
-        idx = longest_dfa_sequence(df_dst['frame_length'].values.tolist(), df_dst['frame_time'].values.tolist(),
-                                   append_rule=DETECTION_RULES[website])
-
+    if search is None:
+        sequences = longest_sequences([(frame_lengths, frame_times) for df_dst, frame_lengths, frame_times in flows],
+                                      website, workers)
+    else:
+        sequences = search.longest(website)
+    for (df_dst, frame_lengths, frame_times), idx in zip(flows, sequences):
         if len(idx) > len(result):
             result = df_dst.iloc[idx]
 
+    return drop_last_jump(result, website)
+
+
+def drop_last_jump(result, website):
     # Remove last, if Google makes big jump
     if website == 'google' and len(result) > 1 and np.diff(result.tail(2)['frame_length'])[0] >= 4:
         result.drop(result.tail(1).index, inplace=True)
@@ -135,18 +364,22 @@ def detect_keystrokes(df, website):
     return result
 
 
-def detect_website_keystrokes(df):
+def detect_website_keystrokes(df, workers=1):
     '''
     Try to detect keystrokes using each rule, keep the longest
     '''
     website_out = ''
     keystrokes_out = []
+    flows = split_flows(df)
 
-    for website, rule in DETECTION_RULES.items():
-        keystrokes = detect_keystrokes(df, website)
+    # The flows are published and the workers started once for all rules
+    with SequenceSearch([(frame_lengths, frame_times) for df_dst, frame_lengths, frame_times in flows],
+                        workers) as search:
+        for website, rule in DETECTION_RULES.items():
+            keystrokes = detect_keystrokes(df, website, flows, search=search)
 
-        if len(keystrokes) > len(keystrokes_out):
-            keystrokes_out = keystrokes
-            website_out = website
+            if len(keystrokes) > len(keystrokes_out):
+                keystrokes_out = keystrokes
+                website_out = website
 
     return website_out, keystrokes_out
@@ -13,40 +13,127 @@
 # ----------------------------------------------------------------
 
 
-from .util import load_pcap
-from .detection import detect_website_keystrokes, detect_keystrokes
+from .util import load_pcap, KeystrokeLoader
+from .detection import detect_website_keystrokes, detect_keystrokes, split_flows, longest_sequences, \
+    drop_last_jump, DETECTION_RULES, SPIKE_BUCKET_SIZE
 from .tokenization import tokenize_words
+from ..time_store import TimeStore
 import math
+import numpy as np
 
+# Gap (ms) between the candidates of a flow that ends a search session, for rules without a max_gap
+SESSION_GAP = 10000
+# Keystrokes a sequence needs to be reported as search session
+MIN_SESSION_KEYSTROKES = 3
+# Incoming bytes in a SPIKE_BUCKET_SIZE bucket that make it a network spike
+SPIKE_MIN_LOAD = 100000
 
-def mini_kreep(pcap, max_word_len, website=None):
-    # Load the pcap
-    pcap, pcap_in = load_pcap(pcap, website)
+
+def mini_kreep(pcap, max_word_len, website=None, cache_dir=None, workers=1, memory_budget=None, reverse_dns=False,
+               passive_dns=None):
+    # Load the pcap, unless it was already decoded together with other consumers
+    if isinstance(pcap, KeystrokeLoader):
+        pcap, pcap_in = pcap.get_frames()
+    else:
+        pcap, pcap_in = load_pcap(pcap, website, cache_dir, workers, memory_budget, reverse_dns, passive_dns)
 
     # Load the dictionary, language, and timing models
     #language, words = load_language(language)
 
     if website is None:
-        website, keystrokes = detect_website_keystrokes(pcap)
+        website, keystrokes = detect_website_keystrokes(pcap, workers=workers)
+    else:
+        keystrokes = detect_keystrokes(pcap, website, workers=workers)
+
+    word_lengths, keystrokes = keystroke_word_lengths(keystrokes, pcap_in, website, max_word_len)
+
+    return word_lengths, keystrokes['frame_time'].max(), keystrokes['dst'].max(), keystrokes['frame_length'].max(), pcap
+
+
+class SearchSession:
+    """
+    A search found by search_sessions: the word lengths, the detected keystrokes and the time of the first and
+    last keystroke
+    """
+    def __init__(self, word_lengths, keystrokes):
+        self.word_lengths = word_lengths
+        self.keystrokes = keystrokes
+        self.start_time = keystrokes['frame_time'].min()
+        self.end_time = keystrokes['frame_time'].max()
+        self.dst = keystrokes['dst'].max()
+
+
+def search_sessions(pcap, max_word_len, website='google', cache_dir=None, workers=1, memory_budget=None,
+                    session_gap=None, reverse_dns=False, passive_dns=None):
+    """
+    Finds every search in the trace instead of only the longest keystroke sequence. The candidates of every flow
+    are split in sessions at inactivity gaps (the max_gap of the rule, or session_gap) and at network spikes,
+    the longest sequence of every session is tokenized like in mini_kreep. The sessions of all flows are searched
+    by the workers at once.
+    Returns the SearchSessions ordered by time, of overlapping sessions only the longest is kept.
+    """
+    if isinstance(pcap, KeystrokeLoader):
+        pcap, pcap_in = pcap.get_frames()
     else:
-        keystrokes = detect_keystrokes(pcap, website)
+        pcap, pcap_in = load_pcap(pcap, website, cache_dir, workers, memory_budget, reverse_dns, passive_dns)
 
+    rule = DETECTION_RULES[website]
+    if session_gap is None:
+        session_gap = SESSION_GAP if rule.max_gap is None else rule.max_gap
+    spikes = estimate_network_spikes(pcap_in)
+
+    df_sessions = []
+    for df_flow, frame_lengths, frame_times in split_flows(pcap):
+        store = TimeStore(df_flow['frame_time'].values)
+        df_flow = df_flow.iloc[store.order]
+
+        # A sequence never crosses a gap its rule rejects, or a spike
+        for start, end in store.sessions(session_gap, spikes):
+            df_sessions.append(df_flow.iloc[start:end])
+
+    sessions = []
+    sequences = longest_sequences([(df_session['frame_length'].values.tolist(),
+                                    df_session['frame_time'].values.tolist()) for df_session in df_sessions],
+                                  website, workers)
+    for df_session, idx in zip(df_sessions, sequences):
+        keystrokes = drop_last_jump(df_session.iloc[idx].copy(), website)
+        if len(keystrokes) >= MIN_SESSION_KEYSTROKES:
+            word_lengths, keystrokes = keystroke_word_lengths(keystrokes, pcap_in, website, max_word_len)
+            sessions.append(SearchSession(word_lengths, keystrokes))
+
+    sessions.sort(key=lambda session: session.start_time)
+    result = []
+    for session in sessions:
+        if len(result) > 0 and session.start_time <= result[-1].end_time:
+            if len(session.keystrokes) > len(result[-1].keystrokes):
+                result[-1] = session
+        else:
+            result.append(session)
+    return result
+
+
+def keystroke_word_lengths(keystrokes, pcap_in, website, max_word_len):
+    """
+    Removes the keystrokes misread around network spikes of the incoming traffic and tokenizes the rest into words.
+    Returns the word lengths and the remaining keystrokes.
+    """
     # Detect if a keystroke is detected outside the 'normal' range
     spikes = estimate_network_spikes(pcap_in)
     number_of_packets = len(keystrokes.index)
+    store = TimeStore(keystrokes['frame_time'].values)
     for spike in spikes:
-        spike_grouped = keystrokes['frame_time'] <= spike
-        s = spike_grouped.sum()
+        s = store.count_until(spike)
         if s == number_of_packets:  # All packets smaller than peak
             break
         elif s == 0:  # All packets larger then peak (check next)
             continue
         elif math.floor(2 * number_of_packets / 3) < s < number_of_packets:  # More than 2/3 of the packets smaller than peak
-            keystrokes = keystrokes[spike_grouped]
+            keystrokes = keystrokes[keystrokes['frame_time'] <= spike]
             print('Removed', number_of_packets - s, 'potential keystrokes at the back as they were probably misread')
             break
         elif 0 < s < math.ceil(1 * number_of_packets / 3):  # Less than 1/3 of the packets is in front of a peak
-            keystrokes = keystrokes[~spike_grouped]
+            keystrokes = keystrokes[keystrokes['frame_time'] > spike]
+            store = TimeStore(keystrokes['frame_time'].values)
             print('Removed', s, 'potential keystrokes in the front as they were probably misread')
         else:
             print('Peak in middle of search string detected, possibly false detection')
@@ -61,10 +148,13 @@ def mini_kreep(pcap, max_word_len, website=None):
     for tok in keystrokes['token']:
         word_lengths[tok] += 1
 
-    return word_lengths, keystrokes['frame_time'].max(), keystrokes['dst'].max(), keystrokes['frame_length'].max(), pcap
+    return word_lengths, keystrokes
 
 
 def estimate_network_spikes(trace):
-    length_group_size = 500
-    agg_lens = trace.groupby(trace['frame_time'] // length_group_size * length_group_size)['frame_length'].sum()
-    return agg_lens[agg_lens > 100000].keys()
+    """
+    Sorted start times of the SPIKE_BUCKET_SIZE buckets with more than SPIKE_MIN_LOAD incoming bytes
+    """
+    bucket_starts, bucket_lens = TimeStore(trace['frame_time'].values,
+                                           trace['frame_length'].values.astype(np.int64)).bucket_sums(SPIKE_BUCKET_SIZE)
+    return bucket_starts[bucket_lens > SPIKE_MIN_LOAD]
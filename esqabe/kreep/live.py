@@ -0,0 +1,135 @@
+# ---------------------------------------------------------------
+# kreep - keystroke recognition and entropy elimination program
+#   by Vinnie Monaco
+#   www.vmonaco.com
+#   contact AT vmonaco DOT com
+#
+#   Licensed under GPLv3
+#
+# ----------------------------------------------------------------
+# Changes made by Isaac Meers
+#   - Improved detection of Google Search traffic
+#   - Reduced version of Kreep, only detection and tokenization
+# ----------------------------------------------------------------
+
+
+import collections
+import heapq
+import math
+import pandas as pd
+from ..trace_decoder import decode_packets
+from ..pcapng_reader import PcapngReader
+from .util import KeystrokeLoader, EngineClassifier, parse_packet, INCOMING
+from ..host_evidence import HostEvidence
+from ..passive_dns import PASSIVE_DNS_MAX_AGE
+from .detection import DETECTION_RULES, DFASequence, drop_last_jump, SPIKE_BUCKET_SIZE
+from .kreep import keystroke_word_lengths
+
+# Keystroke candidates and incoming traffic older than this (ms) before the newest packet are forgotten
+LIVE_WINDOW = 60000
+
+
+class LiveKreep:
+    """
+    mini_kreep for a trace that is still being captured, e.g. pcapng from `tshark -w -` on stdin or a named pipe.
+    Only the keystroke candidates per flow and the incoming traffic per spike bucket of the last window ms are kept.
+    Whenever a new candidate changes the detected keystrokes, on_update(word_lengths, keystrokes) is called.
+    A new candidate extends the DFASequence of its flow, the candidates that leave the window are dropped from it.
+    The flows expire in order of their oldest candidate.
+    """
+    def __init__(self, website, max_word_len, on_update, window=LIVE_WINDOW, reverse_dns=False, passive_dns=None):
+        self.website = website
+        self.evidence = HostEvidence()
+        self.classifier = EngineClassifier(website, reverse_dns, self.evidence, passive_dns)
+        self.max_word_len = max_word_len
+        self.on_update = on_update
+        self.window = window
+        self.capture_filters = KeystrokeLoader(website).capture_filters
+        # Flows in order of appearance, like the flows in detect_keystrokes
+        self.flows = collections.OrderedDict()
+        # The DFASequence of the candidates of every flow
+        self.flow_sequences = {}
+        self.flow_keystrokes = {}
+        self.changed_flows = set()
+        # Heap of (time of the oldest candidate, flow), one entry per flow
+        self.expiry = []
+        self.in_bucket_lengths = collections.OrderedDict()
+        self.latest_time = -math.inf
+        self.result = None
+        self.keystroke_times = None
+
+    def run(self, fileobj):
+        """
+        Decodes the pcapng stream until it is closed
+        """
+        decode_packets(PcapngReader(fileobj), [self])
+
+    def handle_packet(self, packet):
+        self.classifier.forget(self.evidence.handle_packet(packet))
+        self.latest_time = max(self.latest_time, packet.frame_time)
+        self.classifier.since = self.latest_time - PASSIVE_DNS_MAX_AGE
+        rows, dir = parse_packet(packet, self.classifier)
+        self.__forget(self.latest_time - self.window)
+
+        if dir == INCOMING:
+            for src, dst, frame_time, frame_length, protocol in rows:
+                bucket = frame_time // SPIKE_BUCKET_SIZE * SPIKE_BUCKET_SIZE
+                self.in_bucket_lengths[bucket] = self.in_bucket_lengths.get(bucket, 0) + frame_length
+        elif len(rows) > 0:
+            for row in rows:
+                flow = (row[0], row[1], row[4])
+                if flow not in self.flows:
+                    self.flows[flow] = collections.deque()
+                    self.flow_sequences[flow] = DFASequence(DETECTION_RULES[self.website])
+                    heapq.heappush(self.expiry, (row[2], flow))
+                self.flows[flow].append(row)
+                self.flow_sequences[flow].append(row[3], row[2])
+                self.changed_flows.add(flow)
+            self.__update()
+
+    def __forget(self, min_time):
+        while len(self.expiry) > 0 and self.expiry[0][0] < min_time:
+            oldest, flow = heapq.heappop(self.expiry)
+            rows = self.flows[flow]
+            count = 0
+            while len(rows) > 0 and rows[0][2] < min_time:
+                rows.popleft()
+                count += 1
+            if len(rows) == 0:
+                del self.flows[flow]
+                del self.flow_sequences[flow]
+                self.flow_keystrokes.pop(flow, None)
+                self.changed_flows.discard(flow)
+            else:
+                heapq.heappush(self.expiry, (rows[0][2], flow))
+                self.flow_sequences[flow].drop(count)
+                self.changed_flows.add(flow)
+
+        while len(self.in_bucket_lengths) > 0 and next(iter(self.in_bucket_lengths)) + SPIKE_BUCKET_SIZE < min_time:
+            self.in_bucket_lengths.popitem(last=False)
+
+    def __update(self):
+        for flow in self.changed_flows:
+            rows = self.flows[flow]
+            self.flow_keystrokes[flow] = [rows[i] for i in self.flow_sequences[flow].longest()]
+        self.changed_flows.clear()
+
+        result = []
+        for flow in self.flows:
+            if len(self.flow_keystrokes[flow]) > len(result):
+                result = self.flow_keystrokes[flow]
+        if result == self.result:
+            return
+
+        self.result = result
+        keystrokes = drop_last_jump(pd.DataFrame(result, columns=KeystrokeLoader.COLUMNS), self.website)
+        keystroke_times = keystrokes['frame_time'].tolist()
+        if len(keystrokes) == 0 or keystroke_times == self.keystroke_times:
+            return
+
+        self.keystroke_times = keystroke_times
+        pcap_in = pd.DataFrame({'frame_time': list(self.in_bucket_lengths.keys()),
+                                'frame_length': list(self.in_bucket_lengths.values())},
+                               columns=KeystrokeLoader.COLUMNS)
+        word_lengths, keystrokes = keystroke_word_lengths(keystrokes, pcap_in, self.website, self.max_word_len)
+        self.on_update(word_lengths, keystrokes)
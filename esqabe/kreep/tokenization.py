@@ -13,6 +13,7 @@
 # ----------------------------------------------------------------
 
 import numpy as np
+import pandas as pd
 
 
 def google_detect_space(df):
@@ -45,54 +46,60 @@ def detect_space(df, website, max_word_length):
         'baidu': baidu_detect_space
     }
 
-    df = df.copy()
-    df['cp'] = np.arange(1, len(df)+1)
-    df['predict_space'] = detect_space_rules[website](df)
+    space = detect_space_rules[website](df).values.astype(bool)
+    n = len(space)
 
     # No spaces at begin/end
-    df.iloc[0, df.columns.get_loc('predict_space')] = False
-    df.iloc[-1, df.columns.get_loc('predict_space')] = False
-
-    # No consecutive spaces, keep first
-    reset = df['predict_space'].astype(int).diff() > 0
-    cumsum = reset.cumsum()
-    rolling_space = df['predict_space'].groupby(reset.cumsum()).cumsum()
-    df['predict_space'] = df['predict_space'] & ((rolling_space % 2) == 1)
-
-    word_lengths = lambda x: x.groupby(x.cumsum()).apply(lambda y: (~y).sum())
-
-    def split_word(x):
-        '''
-        For tokens longer than any dictionary word, try to split the token by
-        recovering a false negative due to (in this order):
-            * cp changing from 9 to 10
-            * difference greater than 2
-            * difference less than 0
-            * largest packet interval-arrival time
-        '''
-        space = x['predict_space']
-
-        if (~space).sum() > max_word_length:
-            d = x['frame_length'].diff()[1:-1]
-
-            if 10 in x['cp'].values[1:-1]:
-                idx = (x['cp']==10).idxmax()
-            elif (d >= 2).any():
-                idx = d.idxmax()
-            elif (d < 0).any():
-                idx = d.idxmin()
-            else:
-                dt = x['frame_time'].diff().shift(-1)[1:-1]
-                idx = dt.idxmax()
-
-            x.loc[idx, 'predict_space'] = True
-
-        return x
-
-    while word_lengths(df['predict_space']).max() > max_word_length:
-        df = df.groupby(df['predict_space'].cumsum()).apply(split_word)
-
-    return df['predict_space']
+    space[0] = False
+    space[-1] = False
+
+    # No consecutive spaces, keep the 1st, 3rd, ... of every run
+    positions = np.arange(n)
+    run_start = space & ~np.concatenate(([False], space[:-1]))
+    position_in_run = positions - np.maximum.accumulate(np.where(run_start, positions, 0))
+    space &= (position_in_run % 2) == 0
+
+    split_long_words(space, df['frame_length'].values, df['frame_time'].values, max_word_length)
+
+    return pd.Series(space, index=df.index, name='predict_space')
+
+
+def split_long_words(space, frame_length, frame_time, max_word_length):
+    '''
+    For tokens longer than any dictionary word, try to split the token by
+    recovering a false negative due to (in this order):
+        * cp changing from 9 to 10
+        * difference greater than 2
+        * difference less than 0
+        * largest packet interval-arrival time
+    Every token starts at a space (or the first keystroke), the parts of a split
+    token are split again until no token is too long. Updates space in place.
+    '''
+    bounds = np.concatenate(([0], np.flatnonzero(space[1:]) + 1, [len(space)]))
+    tokens = [(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    while len(tokens) > 0:
+        start, end = tokens.pop()
+        # Only the first keystroke of a token can be a space
+        if end - start - space[start] <= max_word_length:
+            continue
+
+        # Candidates are the keystrokes in the token but not the first or last one, cp is the position + 1
+        inner = slice(start + 1, end - 1)
+        d = frame_length[inner] - frame_length[start:end - 2]
+        if start + 1 <= 9 < end - 1:
+            idx = 9
+        elif (d >= 2).any():
+            idx = start + 1 + int(np.argmax(d))
+        elif (d < 0).any():
+            idx = start + 1 + int(np.argmin(d))
+        else:
+            dt = frame_time[start + 2:end] - frame_time[inner]
+            idx = start + 1 + int(np.argmax(dt))
+
+        space[idx] = True
+        tokens.append((start, idx))
+        tokens.append((idx, end))
 
 
 def tokenize_words(df, website, max_word_length):
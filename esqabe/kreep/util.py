@@ -14,108 +14,395 @@
 
 
 import dpkt
+import math
+import os
+import re
 import socket
 import pandas as pd
-
-IS_GOOGLE = {}
+import numpy as np
+from ..trace_decoder import TraceDecoder
+from ..trace_cache import strings_to_array, array_to_strings
+from ..capture_filter import CaptureFilter, PortDirection
+from ..ip_prefixes import PrefixTrie
+from ..reverse_dns import ReverseDNSResolver
+from ..host_evidence import HostEvidence, DNS_PORT
+from ..passive_dns import PASSIVE_DNS_MAX_AGE
+from .detection import MIN_GET_LENGTH, SPIKE_BUCKET_SIZE
 
 INCOMING = 0
 OUTGOING = 1
 UNKNOWN = 2
 
+HTTPS_PORT = 443
+TLS_RECORD_HEADER_LEN = 5
+
+PREFIX_DIR = os.path.join(os.path.dirname(__file__), 'prefixes')
+# Prefix file (in PREFIX_DIR) and reverse DNS suffix of the servers of the engines with known addresses, the
+# keystrokes of other engines are searched in all HTTPS traffic
+ENGINE_ADDRESSES = {
+    'google': ('google.txt', '1e100.net'),
+}
+# Host names of the engine, an IP the trace names with one of them (SNI, DNS) belongs to the engine
+ENGINE_HOSTNAMES = {
+    'google': re.compile(r'(^|\.)google(\.[a-z]{2,3}){1,2}$'),
+}
+# Loaded prefix tries per engine, shared by all classifiers of the process
+ENGINE_PREFIXES = {}
+
 
 def ip_to_str(inet):
     """Convert inet object to a string
         Source: https://dpkt.readthedocs.io/en/latest/_modules/examples/print_packets.html#mac_addr
     """
-    # First try ipv4 and then ipv6
-    try:
-        return socket.inet_ntop(socket.AF_INET, inet)
-    except ValueError:
-        return socket.inet_ntop(socket.AF_INET6, inet)
+    return socket.inet_ntop(socket.AF_INET6 if len(inet) == 16 else socket.AF_INET, inet)
 
 
-def load_pcap(fname, website):
+def load_pcap(fname, website, cache_dir=None, workers=1, memory_budget=None, reverse_dns=False, passive_dns=None):
     """
     Load a pcap (ng) into a pandas DataFrame
     """
-    rows = []
-    rows_in = []
-    for ts, buf in dpkt.pcapng.Reader(open(fname, 'rb')):
-        row, dir = parse_eth(buf, ts, website)
+    if reverse_dns is True:
+        reverse_dns = ReverseDNSResolver.for_cache_dir(cache_dir)
+    loader = KeystrokeLoader(website, memory_budget, reverse_dns, passive_dns)
+    TraceDecoder(fname, cache_dir, workers).add_consumer(loader).decode()
+    return loader.get_frames()
+
+
+class KeystrokeLoader:
+    """
+    TraceDecoder consumer collecting the (potential) keystroke packets of a search engine.
+    With a memory budget the incoming packets are not kept, only their length summed per SPIKE_BUCKET_SIZE bucket,
+    which is all estimate_network_spikes needs. The outgoing rows are already limited to TLS records of the engine.
+    Packets to the prefixes of the engine are added while decoding. The rows of the other packets are kept undecided,
+    also in the cached state, together with the host names the trace gives the IPs (see HostEvidence), for that the
+    DNS responses are handled as well. get_frames decides them with the names of the whole trace, so the chunks of a
+    parallel decoder, which only know their own names, give the same frames as a serial decode. The IPs the trace
+    does not name as the engine are then looked up in the passive DNS store and with reverse DNS, when given, their
+    answers are never cached. The undecided packets are inserted in their original order.
+    """
+    COLUMNS = ['src', 'dst', 'frame_time', 'frame_length', 'protocol']
+
+    def __init__(self, website, memory_budget=None, reverse_dns=False, passive_dns=None):
+        self.website = website
+        self.evidence = HostEvidence()
+        self.classifier = EngineClassifier(website, reverse_dns, self.evidence, passive_dns)
+        # (dst ip, src ip, outgoing rows, incoming rows, position in rows, position in rows_in) of undecided packets
+        self.undecided = []
+        # When bounded, the incoming lengths per bucket of the undecided packets, by (dst ip, src ip)
+        self.undecided_buckets = {}
+        self.latest_time = -math.inf
+        self.rows = []
+        self.rows_in = []
+        self.bounded = memory_budget is not None
+        self.in_bucket_lengths = {}
+        # Outgoing packets need at least one TLS record bigger than a GET request
+        self.capture_filters = [
+            CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], ports=[HTTPS_PORT], direction=PortDirection.DST,
+                          min_payload_length=MIN_GET_LENGTH + 1 + TLS_RECORD_HEADER_LEN),
+            CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], ports=[HTTPS_PORT], direction=PortDirection.SRC,
+                          min_payload_length=1),
+            CaptureFilter(protocols=[dpkt.ip.IP_PROTO_UDP], ports=[DNS_PORT], direction=PortDirection.SRC)
+        ]
+
+    def handle_packet(self, packet):
+        self.evidence.handle_packet(packet)
+        self.latest_time = max(self.latest_time, packet.frame_time)
+        if packet.protocol != dpkt.ip.IP_PROTO_TCP:
+            return
+
+        if not self.classifier.has_addresses:
+            self.__add(*parse_packet(packet, self.classifier))
+        elif packet.dst_ip in engine_prefixes(self.website):
+            self.__add(parse_tcp(packet, OUTGOING), OUTGOING)
+        else:
+            self.__defer(packet)
+
+    def __defer(self, packet):
+        # The rows of both directions are kept, which one is used only the names of the whole trace can tell
+        out_rows = parse_tcp(packet, OUTGOING)
+        in_rows = parse_tcp(packet, INCOMING) if packet.src_port == HTTPS_PORT else out_rows
+        if self.bounded and len(in_rows) > 0:
+            buckets = self.undecided_buckets.setdefault((packet.dst_ip, packet.src_ip), {})
+            for src, dst, frame_time, frame_length, protocol in in_rows:
+                self.__add_in_length(frame_time // SPIKE_BUCKET_SIZE * SPIKE_BUCKET_SIZE, frame_length, buckets)
+            in_rows = []
+
+        if len(out_rows) > 0 or len(in_rows) > 0:
+            self.undecided.append((packet.dst_ip, packet.src_ip, out_rows, in_rows, len(self.rows), len(self.rows_in)))
+
+    def __add(self, row, dir):
         if dir == INCOMING:
-            rows_in.extend(row)
+            if self.bounded:
+                for src, dst, frame_time, frame_length, protocol in row:
+                    self.__add_in_length(frame_time // SPIKE_BUCKET_SIZE * SPIKE_BUCKET_SIZE, frame_length)
+            else:
+                self.rows_in.extend(row)
         else:
-            rows.extend(row)
-    df = pd.DataFrame(rows, columns=['src', 'dst', 'frame_time', 'frame_length', 'protocol'])
-    df_in = pd.DataFrame(rows_in, columns=['src', 'dst', 'frame_time', 'frame_length', 'protocol'])
-    return df, df_in
+            self.rows.extend(row)
 
+    def __add_in_length(self, bucket, frame_length, in_bucket_lengths=None):
+        in_bucket_lengths = self.in_bucket_lengths if in_bucket_lengths is None else in_bucket_lengths
+        in_bucket_lengths[bucket] = in_bucket_lengths.get(bucket, 0) + frame_length
 
-def parse_eth(buf, ts, website):
-    eth = dpkt.ethernet.Ethernet(buf)
-    if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-        return parse_ip(eth.data, ts, website)
-    return [], UNKNOWN
+    def cache_key(self):
+        return 'keystrokes-' + str(self.website) + ('-bounded' if self.bounded else '')
+
+    def get_state(self):
+        state = {}
+        rows_to_state(state, 'out', self.rows)
+        rows_to_state(state, 'in', self.rows_in)
+        state['undecided_dst'] = strings_to_array(packet[0] for packet in self.undecided)
+        state['undecided_src'] = strings_to_array(packet[1] for packet in self.undecided)
+        for name, index in (('out', 2), ('in', 3)):
+            state['undecided_' + name + '_position'] = np.array([packet[index + 2] for packet in self.undecided],
+                                                                dtype=np.int64)
+            state['undecided_' + name + '_packet'] = np.array([k for k, packet in enumerate(self.undecided)
+                                                               for row in packet[index]], dtype=np.int64)
+            rows_to_state(state, 'undecided_' + name, [row for packet in self.undecided for row in packet[index]])
+
+        buckets = [(ips, bucket, frame_length) for ips, lengths in self.undecided_buckets.items()
+                   for bucket, frame_length in lengths.items()]
+        state['undecided_bucket_dst'] = strings_to_array(ips[0] for ips, bucket, frame_length in buckets)
+        state['undecided_bucket_src'] = strings_to_array(ips[1] for ips, bucket, frame_length in buckets)
+        state['undecided_buckets'] = np.array([bucket for ips, bucket, frame_length in buckets], dtype=np.float64)
+        state['undecided_bucket_lengths'] = np.array([frame_length for ips, bucket, frame_length in buckets],
+                                                     dtype=np.int64)
+
+        names = [(ip, name) for ip, ip_names in self.evidence.hostnames.items() for name in ip_names]
+        state['evidence_ip'] = strings_to_array(ip for ip, name in names)
+        state['evidence_name'] = strings_to_array(name for ip, name in names)
+        state['latest_time'] = np.array([self.latest_time], dtype=np.float64)
+        state['in_buckets'] = np.fromiter(self.in_bucket_lengths.keys(), dtype=np.float64,
+                                          count=len(self.in_bucket_lengths))
+        state['in_bucket_lengths'] = np.fromiter(self.in_bucket_lengths.values(), dtype=np.int64,
+                                                 count=len(self.in_bucket_lengths))
+        return state
+
+    def merge_state(self, state):
+        undecided = [(dst_ip, src_ip, [], [], position + len(self.rows), in_position + len(self.rows_in))
+                     for dst_ip, src_ip, position, in_position in zip(
+                         array_to_strings(state['undecided_dst']), array_to_strings(state['undecided_src']),
+                         state['undecided_out_position'].tolist(), state['undecided_in_position'].tolist())]
+        for name, index in (('out', 2), ('in', 3)):
+            rows = rows_from_state(state, 'undecided_' + name)
+            for k, row in zip(state['undecided_' + name + '_packet'].tolist(), rows):
+                undecided[k][index].append(row)
+        self.undecided.extend(undecided)
+
+        for dst_ip, src_ip, bucket, frame_length in zip(
+                array_to_strings(state['undecided_bucket_dst']), array_to_strings(state['undecided_bucket_src']),
+                state['undecided_buckets'].tolist(), state['undecided_bucket_lengths'].tolist()):
+            self.__add_in_length(bucket, frame_length, self.undecided_buckets.setdefault((dst_ip, src_ip), {}))
+        for ip, name in zip(array_to_strings(state['evidence_ip']), array_to_strings(state['evidence_name'])):
+            self.evidence.add(ip, name)
+        self.latest_time = max(self.latest_time, float(state['latest_time'][0]))
+
+        self.rows.extend(rows_from_state(state, 'out'))
+        self.rows_in.extend(rows_from_state(state, 'in'))
+        for bucket, frame_length in zip(state['in_buckets'].tolist(), state['in_bucket_lengths'].tolist()):
+            self.__add_in_length(bucket, frame_length)
+
+    def get_frames(self):
+        """
+        Returns the outgoing and incoming packets. When bounded, every incoming row is a bucket with its summed length.
+        """
+        rows, rows_in, in_bucket_lengths = self.__decide_undecided()
+        df = pd.DataFrame(rows, columns=self.COLUMNS)
+        if self.bounded:
+            buckets = sorted(in_bucket_lengths.items())
+            df_in = pd.DataFrame({'frame_time': [bucket for bucket, frame_length in buckets],
+                                  'frame_length': [frame_length for bucket, frame_length in buckets]},
+                                 columns=self.COLUMNS)
+        else:
+            df_in = pd.DataFrame(rows_in, columns=self.COLUMNS)
+        return df, df_in
 
+    def __decide_undecided(self):
+        """
+        Rows and incoming bucket lengths with the undecided packets of the engine inserted at their original position,
+        the undecided packets themselves are kept
+        """
+        if len(self.undecided) == 0 and len(self.undecided_buckets) == 0:
+            return self.rows, self.rows_in, self.in_bucket_lengths
 
-def parse_ip(ip, ts, website):
-    if ip.p == dpkt.ip.IP_PROTO_TCP:
+        ips = {ip for packet in self.undecided for ip in packet[:2]} | {ip for ips in self.undecided_buckets
+                                                                       for ip in ips}
+        # Classified again with the names of the whole trace, which the classifier did not have before the merge
+        self.classifier.forget(ips)
+        # Like the mappings of the traces, only what the store saw recently enough before this trace
+        self.classifier.since = self.latest_time - PASSIVE_DNS_MAX_AGE
+        self.classifier.resolve(ips)
+        is_engine = self.classifier.is_engine
+
+        rows, rows_in = [], []
+        done, done_in = 0, 0
+        for dst_ip, src_ip, out_rows, in_rows, position, in_position in self.undecided:
+            if is_engine(dst_ip):
+                rows.extend(self.rows[done:position])
+                rows.extend(out_rows)
+                done = position
+            elif is_engine(src_ip):
+                rows_in.extend(self.rows_in[done_in:in_position])
+                rows_in.extend(in_rows)
+                done_in = in_position
+        rows.extend(self.rows[done:])
+        rows_in.extend(self.rows_in[done_in:])
+
+        in_bucket_lengths = dict(self.in_bucket_lengths)
+        for (dst_ip, src_ip), lengths in self.undecided_buckets.items():
+            if not is_engine(dst_ip) and is_engine(src_ip):
+                for bucket, frame_length in lengths.items():
+                    self.__add_in_length(bucket, frame_length, in_bucket_lengths)
+        return rows, rows_in, in_bucket_lengths
+
+
+def rows_to_state(state, name, rows):
+    src, dst, frame_time, frame_length, protocol = zip(*rows) if len(rows) > 0 else ([], [], [], [], [])
+    state[name + '_src'] = strings_to_array(src)
+    state[name + '_dst'] = strings_to_array(dst)
+    state[name + '_frame_time'] = np.array(frame_time, dtype=np.float64)
+    state[name + '_frame_length'] = np.array(frame_length, dtype=np.int64)
+    state[name + '_protocol'] = np.array(protocol, dtype=np.int64)
+
+
+def rows_from_state(state, name):
+    return list(zip(array_to_strings(state[name + '_src']), array_to_strings(state[name + '_dst']),
+                    state[name + '_frame_time'].tolist(), state[name + '_frame_length'].tolist(),
+                    state[name + '_protocol'].tolist()))
+
+
+def parse_packet(packet, classifier):
+    if packet.protocol == dpkt.ip.IP_PROTO_TCP:
         dir = UNKNOWN
-        can_parse = website != 'google'
+        can_parse = not classifier.has_addresses
 
-        if website == 'google' and is_from_google(ip_to_str(ip.dst)):
+        if classifier.has_addresses and classifier.is_engine(packet.dst_ip):
             can_parse = True
             dir = OUTGOING
-        elif website == 'google' and is_from_google(ip_to_str(ip.src)):
+        elif classifier.has_addresses and classifier.is_engine(packet.src_ip):
             can_parse = True
             dir = INCOMING
 
         if can_parse:
-            return parse_tcp(ip.data, ts, ip, dir), dir
+            return parse_tcp(packet, dir), dir
     return [], UNKNOWN
 
 
-def parse_tcp(tcp, ts, ip, dir):
-    if len(tcp.data) > 0:  # Ignores HTTP, only HTTPS, currently no QUIC support
-        if dir == INCOMING and tcp.sport == 443:
-            return [(ip_to_str(ip.src) + ':' + str(tcp.sport),
-                     ip_to_str(ip.dst) + ':' + str(tcp.dport), ts * 1000,
-                     len(tcp.data), ip.p)]
-        elif tcp.dport == 443:
-            return parse_tls(tcp, ts, ip)
+def parse_tcp(packet, dir):
+    if packet.payload_length > 0:  # Ignores HTTP, only HTTPS, currently no QUIC support
+        if dir == INCOMING and packet.src_port == HTTPS_PORT:
+            return [(packet.src_ip + ':' + str(packet.src_port),
+                     packet.dst_ip + ':' + str(packet.dst_port), packet.frame_time,
+                     packet.payload_length, packet.protocol)]
+        elif packet.dst_port == HTTPS_PORT:
+            return parse_tls(packet)
 
     return []
 
 
-def parse_tls(tcp, ts, ip):
+def parse_tls(packet):
     try:
-        tls_records, i = dpkt.ssl.tls_multi_factory(tcp.data)
+        tls_records, i = dpkt.ssl.tls_multi_factory(packet.payload)
     except (dpkt.ssl.SSL3Exception, dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
         return []
 
-    if i < len(tcp.data):
+    if i < len(packet.payload):
         # TODO Possibly not read all TLS Records due to fragmentation
         pass
 
     results = []
     for record in tls_records:
-        if record.type == 23:  # TLS APP DATA
-            results.append((ip_to_str(ip.src) + ':' + str(tcp.sport),
-                            ip_to_str(ip.dst) + ':' + str(tcp.dport), ts * 1000,
-                            len(record.data), ip.p))
+        if record.type == 23 and len(record.data) > MIN_GET_LENGTH:  # TLS APP DATA, smaller than any GET
+            results.append((packet.src_ip + ':' + str(packet.src_port),
+                            packet.dst_ip + ':' + str(packet.dst_port), packet.frame_time,
+                            len(record.data), packet.protocol))
 
     return results
 
 
-def is_from_google(ip):
-    if ip in IS_GOOGLE:
-        return IS_GOOGLE[ip]
+def engine_prefixes(website):
+    if website not in ENGINE_PREFIXES:
+        ENGINE_PREFIXES[website] = PrefixTrie.from_file(os.path.join(PREFIX_DIR, ENGINE_ADDRESSES[website][0]))
+    return ENGINE_PREFIXES[website]
 
-    try:
-        is_google = socket.gethostbyaddr(ip)[0].endswith('1e100.net')
-        IS_GOOGLE[ip] = is_google
-        return is_google
-    except socket.herror:
-        IS_GOOGLE[ip] = False
-        return False
+
+class EngineClassifier:
+    """
+    Decides whether an IP belongs to the servers of a search engine without any network access: first with the
+    host names of the HostEvidence of the trace, then with the published prefixes of the engine. Addresses outside
+    those prefixes that the trace does not name as the engine are looked up in bulk: in the PassiveDNSStore of
+    earlier captures and, as optional fallback, with reverse DNS. Other names only decide without either, shared
+    front ends are often named e.g. www.gstatic.com only.
+    reverse_dns is True for a ReverseDNSResolver without cache or the ReverseDNSResolver to use. Only the mappings
+    the store saw from since (ms) on are used.
+    """
+    def __init__(self, website, reverse_dns=False, evidence=None, passive_dns=None):
+        self.website = website
+        self.resolver = ReverseDNSResolver() if reverse_dns is True else (reverse_dns or None)
+        self.evidence = evidence
+        self.passive_dns = passive_dns
+        self.since = None
+        self.known = {}
+
+    @property
+    def has_addresses(self):
+        return self.website in ENGINE_ADDRESSES
+
+    def classify(self, ip):
+        """
+        Returns whether the ip belongs to the engine, None when only a lookup (see resolve) can tell
+        """
+        if ip in self.known:
+            return self.known[ip]
+
+        names = () if self.evidence is None else self.evidence.names(ip)
+        if self.has_addresses and (self.__is_engine_name(names) or ip in engine_prefixes(self.website)):
+            self.known[ip] = True
+        elif not self.has_addresses or (self.resolver is None and self.passive_dns is None):
+            self.known[ip] = False
+        else:
+            return None
+        return self.known[ip]
+
+    def resolve(self, ips):
+        """
+        Classifies the ips that need a lookup with a single query of the passive DNS store, the ips it does not know
+        with a single concurrent batch of reverse lookups
+        """
+        self.known.update(self.lookup(ip for ip in set(ips) if self.classify(ip) is None))
+
+    def lookup(self, ips):
+        """
+        Returns whether each of the ips belongs to the engine according to the passive DNS store and reverse DNS only
+        """
+        ips = list(set(ips))
+        found = {}
+        if len(ips) > 0 and self.passive_dns is not None:
+            stored = self.passive_dns.domains_of(ips, self.since)
+            for ip, names in stored.items():
+                found[ip] = self.__is_engine_name(names)
+            ips = [ip for ip in ips if ip not in stored]
+
+        if len(ips) > 0 and self.resolver is not None:
+            suffix = ENGINE_ADDRESSES[self.website][1]
+            for ip, hostname in self.resolver.resolve(ips).items():
+                found[ip] = hostname is not None and hostname.endswith(suffix)
+        else:
+            found.update((ip, False) for ip in ips)
+        return found
+
+    def forget(self, ips):
+        """
+        Drops the classification of ips that got new evidence
+        """
+        for ip in ips:
+            self.known.pop(ip, None)
+
+    def __is_engine_name(self, names):
+        pattern = ENGINE_HOSTNAMES.get(self.website)
+        return pattern is not None and any(pattern.search(name) for name in names)
+
+    def is_engine(self, ip):
+        if self.classify(ip) is None:
+            self.resolve([ip])
+        return self.known[ip]
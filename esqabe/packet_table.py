@@ -0,0 +1,343 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+from array import array
+import bisect
+from enum import Enum
+import math
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from .trace_cache import strings_to_array, array_to_strings
+from .time_store import TimeStore
+
+
+class InternalPacketTypes(Enum):
+    DATA = 0
+    TLS_CLIENT_HELLO_SNI = 1
+
+
+class PacketDC(Enum):
+    SRC_IP = 'src_ip'
+    SRC_PORT = 'src_port'
+    DST_IP = 'dst_ip'
+    DST_PORT = 'dst_port'
+    FRAME_TIME = 'frame_time'
+    FRAME_LENGTH = 'frame_length'
+    PROTOCOL = 'protocol'
+    PACKET_TYPE = 'packet_type'
+    PACKET_TYPE_CONTENT = 'packet_type_content'
+
+
+# Typecodes of the array backed columns, IPs are stored as interned ids
+COLUMN_TYPES = {
+    PacketDC.SRC_IP: 'i',
+    PacketDC.SRC_PORT: 'i',
+    PacketDC.DST_IP: 'i',
+    PacketDC.DST_PORT: 'i',
+    PacketDC.FRAME_TIME: 'd',
+    PacketDC.FRAME_LENGTH: 'i',
+    PacketDC.PROTOCOL: 'b',
+    PacketDC.PACKET_TYPE: 'b',
+}
+# Rough memory of a row, in its columns and in the DataFrame built from them, to turn a budget into a row count
+ROW_MEMORY = 64
+# Most rows of a part of a PacketTable state, parts are merged one at a time
+STATE_PART_ROWS = 1 << 20
+
+
+class SegmentColumn:
+    """
+    Column of a spilled segment in a PacketTable state, only read from disk when it is turned into an array (np.savez,
+    np.asarray), so writing or merging a state holds a single segment in memory
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def __array__(self, dtype=None, copy=None):
+        with np.load(self.path, allow_pickle=False) as data:
+            values = data[self.key]
+        return values if dtype is None else values.astype(dtype)
+
+
+class PacketTable:
+    """
+    Columnar store of the packets of a trace. IP addresses are interned to integer ids with a side lookup
+    table and the content of a packet type (e.g. the SNI) is only kept for the rows that have one, in row order.
+    With a memory budget (bytes), the rows are spilled to npz segments in a temporary directory whenever the rows
+    in memory exceed the budget. chunks(), window() and select() then work one segment at a time, as do get_state()
+    and merge_state(). Copies of the table pickled for worker processes spill to the directory of the original.
+    time_store() sorts the frame times and lengths once for the time queries of the stages, these two columns are
+    kept in memory also when the rows are spilled.
+    """
+    def __init__(self, memory_budget=None):
+        self.ip_lookup = []
+        self.ip_ids = {}
+        self.columns = {column: array(typecode) for column, typecode in COLUMN_TYPES.items()}
+        self.content_rows = array('q')
+        self.content_values = []
+        self.max_rows = None if memory_budget is None else max(1, memory_budget // ROW_MEMORY)
+        # (path, first row, row count, minimum frame time, maximum frame time) of every spilled segment
+        self.segments = []
+        self.spilled_rows = 0
+        # The directory is only owned (and removed) by the table that created it
+        self.spill_dir = None
+        self.spill_path = None
+        self.store = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.max_rows is not None:
+            state['spill_path'] = self.__spill_path()
+        state['spill_dir'] = None
+        state['store'] = None
+        return state
+
+    def __len__(self):
+        return self.spilled_rows + len(self.columns[PacketDC.FRAME_TIME])
+
+    def intern_ip(self, ip):
+        ip_id = self.ip_ids.get(ip)
+        if ip_id is None:
+            ip_id = len(self.ip_lookup)
+            self.ip_ids[ip] = ip_id
+            self.ip_lookup.append(ip)
+        return ip_id
+
+    def append(self, frame_time, src_ip, src_port, dst_ip, dst_port, frame_length, protocol,
+               packet_type=InternalPacketTypes.DATA.value, content=None):
+        if content is not None:
+            self.content_rows.append(len(self))
+            self.content_values.append(content)
+
+        self.columns[PacketDC.SRC_IP].append(self.intern_ip(src_ip))
+        self.columns[PacketDC.SRC_PORT].append(src_port)
+        self.columns[PacketDC.DST_IP].append(self.intern_ip(dst_ip))
+        self.columns[PacketDC.DST_PORT].append(dst_port)
+        self.columns[PacketDC.FRAME_TIME].append(frame_time)
+        self.columns[PacketDC.FRAME_LENGTH].append(frame_length)
+        self.columns[PacketDC.PROTOCOL].append(protocol)
+        self.columns[PacketDC.PACKET_TYPE].append(packet_type)
+
+        if self.max_rows is not None and len(self.columns[PacketDC.FRAME_TIME]) >= self.max_rows:
+            self.spill()
+
+    def __spill_path(self):
+        if self.spill_path is None:
+            self.spill_dir = tempfile.TemporaryDirectory(prefix='esqabe-packets-')
+            self.spill_path = self.spill_dir.name
+        return self.spill_path
+
+    def spill(self):
+        """
+        Moves the rows in memory to a new segment on disk
+        """
+        if len(self.columns[PacketDC.FRAME_TIME]) == 0:
+            return
+
+        # Unique names, the copies in worker processes spill to the same directory
+        fd, path = tempfile.mkstemp(dir=self.__spill_path(), prefix='segment-', suffix='.npz')
+        data = self.__memory_columns()
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **{column.value: values for column, values in data.items()})
+
+        times = data[PacketDC.FRAME_TIME]
+        self.segments.append((path, self.spilled_rows, len(times), times.min(), times.max()))
+        self.spilled_rows += len(times)
+        self.columns = {column: array(typecode) for column, typecode in COLUMN_TYPES.items()}
+
+    def __memory_columns(self):
+        return {column: np.frombuffer(values, dtype=values.typecode).copy() for column, values in self.columns.items()}
+
+    def __contents_between(self, first_row, end_row):
+        """
+        Rows in [first_row, end_row) with a packet type content, and their contents
+        """
+        first = bisect.bisect_left(self.content_rows, first_row)
+        last = bisect.bisect_left(self.content_rows, end_row)
+        return np.array(self.content_rows[first:last], dtype=np.int64), \
+            np.array(self.content_values[first:last], dtype=object)
+
+    def column(self, column):
+        """
+        Copy of a column as NumPy array, IP columns contain the interned ids. Spilled segments are loaded too.
+        """
+        values = self.columns[column]
+        memory_values = np.frombuffer(values, dtype=values.typecode).copy()
+        if len(self.segments) == 0:
+            return memory_values
+
+        spilled_values = []
+        for path, first_row, row_count, min_time, max_time in self.segments:
+            with np.load(path, allow_pickle=False) as data:
+                spilled_values.append(data[column.value])
+        return np.concatenate(spilled_values + [memory_values])
+
+    def get_state(self, prefix=''):
+        """
+        State of the rows in parts: one per spilled segment, with SegmentColumns instead of loaded columns, and the
+        rows in memory in parts of at most STATE_PART_ROWS
+        """
+        parts = [(first_row, row_count, {column: SegmentColumn(path, column.value) for column in self.columns})
+                 for path, first_row, row_count, min_time, max_time in self.segments]
+        memory_columns = self.__memory_columns()
+        memory_rows = len(memory_columns[PacketDC.FRAME_TIME])
+        for start in range(0, max(memory_rows, 1), STATE_PART_ROWS):
+            parts.append((self.spilled_rows + start, min(STATE_PART_ROWS, memory_rows - start),
+                          {column: values[start:start + STATE_PART_ROWS] for column, values in memory_columns.items()}))
+
+        state = {prefix + 'ip_lookup': strings_to_array(self.ip_lookup),
+                 prefix + 'part_rows': np.array([row_count for first_row, row_count, columns in parts], dtype=np.int64)}
+        for i, (first_row, row_count, columns) in enumerate(parts):
+            part = '{}part{}_'.format(prefix, i)
+            for column, values in columns.items():
+                state[part + column.value] = values
+            content_rows, content_values = self.__contents_between(first_row, first_row + row_count)
+            state[part + 'content_rows'] = content_rows - first_row
+            state[part + 'contents'] = strings_to_array(content_values)
+        return state
+
+    def merge_state(self, state, prefix=''):
+        """
+        Appends the rows of a state from get_state, re-interning its IPs. A state missing keys of its parts raises a
+        KeyError before any row is added. The parts are loaded one at a time and appended in slices that fit the
+        memory budget, spilling in between. Segments that copies in worker processes spilled to the directory of this
+        table are removed once merged.
+        """
+        part_count = len(state[prefix + 'part_rows'])
+        for i in range(part_count):
+            part = '{}part{}_'.format(prefix, i)
+            for key in [column.value for column in self.columns] + ['content_rows', 'contents']:
+                if part + key not in state:
+                    raise KeyError(part + key)
+
+        ip_ids = np.array([self.intern_ip(ip) for ip in array_to_strings(state[prefix + 'ip_lookup'])],
+                          dtype=np.int32)
+        merged_segments = set()
+        for i in range(part_count):
+            part = '{}part{}_'.format(prefix, i)
+            content_rows = np.asarray(state[part + 'content_rows']) + len(self)
+            self.content_rows.extend(content_rows.tolist())
+            self.content_values.extend(array_to_strings(state[part + 'contents']))
+
+            columns = {}
+            for column in self.columns:
+                values = state[part + column.value]
+                if isinstance(values, SegmentColumn):
+                    merged_segments.add(values.path)
+                values = np.asarray(values)
+                if (column == PacketDC.SRC_IP or column == PacketDC.DST_IP) and len(values) > 0:
+                    values = ip_ids[values]
+                columns[column] = values
+            self.__append_columns(columns)
+
+        own_segments = {segment[0] for segment in self.segments}
+        for path in merged_segments:
+            if self.spill_path is not None and os.path.dirname(path) == self.spill_path and path not in own_segments:
+                os.remove(path)
+
+    def __append_columns(self, columns):
+        row_count = len(columns[PacketDC.FRAME_TIME])
+        start = 0
+        while start < row_count:
+            end = row_count
+            if self.max_rows is not None:
+                end = min(row_count, start + self.max_rows - len(self.columns[PacketDC.FRAME_TIME]))
+            for column, values in self.columns.items():
+                values.frombytes(columns[column][start:end].astype(values.typecode).tobytes())
+            start = end
+
+            if self.max_rows is not None and len(self.columns[PacketDC.FRAME_TIME]) >= self.max_rows:
+                self.spill()
+
+    def time_store(self):
+        """
+        TimeStore of the frame times and lengths, rebuilt only when rows were added since the last call
+        """
+        if self.store is None or len(self.store) != len(self):
+            self.store = TimeStore(self.column(PacketDC.FRAME_TIME), self.column(PacketDC.FRAME_LENGTH).astype(np.int64))
+        return self.store
+
+    def chunks(self, min_time=-math.inf, max_time=math.inf):
+        """
+        Yields the rows as DataFrames, one per spilled segment overlapping [min_time, max_time] and always one for
+        the rows in memory. The rows themselves are not filtered on time, the index is the row number.
+        """
+        for path, first_row, row_count, segment_min_time, segment_max_time in self.segments:
+            if segment_max_time >= min_time and segment_min_time <= max_time:
+                with np.load(path, allow_pickle=False) as data:
+                    yield self.__frame({column: data[column.value] for column in self.columns}, first_row)
+
+        yield self.__frame(self.__memory_columns(), self.spilled_rows)
+
+    def __frame(self, columns, first_row, rows=None):
+        """
+        DataFrame of consecutive rows from first_row on, or of the given ascending rows
+        """
+        row_count = len(columns[PacketDC.FRAME_TIME])
+        index = pd.RangeIndex(first_row, first_row + row_count) if rows is None else pd.Index(rows)
+        data = {}
+        for column in PacketDC:
+            if column == PacketDC.SRC_IP or column == PacketDC.DST_IP:
+                data[column.value] = pd.Categorical.from_codes(columns[column], categories=self.ip_lookup)
+            elif column == PacketDC.PACKET_TYPE_CONTENT:
+                content = np.full(row_count, None, dtype=object)
+                if rows is None:
+                    content_rows, content_values = self.__contents_between(first_row, first_row + row_count)
+                    content[content_rows - first_row] = content_values
+                elif row_count > 0:
+                    content_rows, content_values = self.__contents_between(rows[0], rows[-1] + 1)
+                    positions = np.minimum(np.searchsorted(rows, content_rows), row_count - 1)
+                    found = rows[positions] == content_rows
+                    content[positions[found]] = content_values[found]
+                data[column.value] = pd.Series(content, dtype=object, index=index)
+            else:
+                data[column.value] = columns[column]
+
+        return pd.DataFrame(data, columns=[e.value for e in PacketDC], index=index)
+
+    def select(self, predicate, min_time=-math.inf, max_time=math.inf):
+        """
+        DataFrame of the rows for which predicate(chunk) gives a True mask, built one chunk at a time
+        """
+        return concat_frames([df[predicate(df)] for df in self.chunks(min_time, max_time)])
+
+    def window(self, min_time=-math.inf, max_time=math.inf):
+        """
+        DataFrame of the rows with a frame time in [min_time, max_time]
+        """
+        if min_time == -math.inf and max_time == math.inf:
+            return concat_frames(list(self.chunks()))
+
+        if len(self.segments) == 0:
+            rows = self.time_store().window(min_time, max_time)
+            return self.__frame({column: values[rows] for column, values in self.__memory_columns().items()}, 0, rows)
+
+        return self.select(lambda df: (df[PacketDC.FRAME_TIME.value] >= min_time) &
+                                      (df[PacketDC.FRAME_TIME.value] <= max_time), min_time, max_time)
+
+    def to_df(self):
+        return self.window()
+
+
+def concat_frames(frames):
+    return frames[0] if len(frames) == 1 else pd.concat(frames)
@@ -0,0 +1,84 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import sqlite3
+
+# Mappings last seen longer ago (ms) than this before a capture are not used for it, the IP may have moved
+PASSIVE_DNS_MAX_AGE = 30 * 24 * 3600 * 1000
+# Parameters per query, below the SQLite limit of old versions
+SQLITE_BATCH = 500
+
+
+class PassiveDNSStore:
+    """
+    SQLite store of the IP to domain mappings observed in all processed captures (SNI, DNS answers), with the
+    frame time (ms) the mapping was first and last seen. Indexed on both IP and domain, queried in bulk.
+    Safe to share between the processes of a batch, writers wait for each other.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS observations (ip TEXT NOT NULL, domain TEXT NOT NULL, '
+                               'first_seen REAL NOT NULL, last_seen REAL NOT NULL, PRIMARY KEY (ip, domain))')
+            connection.execute('CREATE INDEX IF NOT EXISTS observations_domain ON observations (domain)')
+
+    def __connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def record(self, observations):
+        """
+        Adds (ip, domain, first seen, last seen) observations, widening the seen range of known mappings
+        """
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.executemany('INSERT INTO observations VALUES (?, ?, ?, ?) ON CONFLICT (ip, domain) DO '
+                                       'UPDATE SET first_seen = min(first_seen, excluded.first_seen), '
+                                       'last_seen = max(last_seen, excluded.last_seen)', observations)
+        finally:
+            connection.close()
+
+    def domains_of(self, ips, since=None):
+        """
+        Returns {ip: set of domains} of the ips with a mapping last seen at or after since
+        """
+        return self.__query('ip', 'domain', ips, since)
+
+    def ips_of(self, domains, since=None):
+        """
+        Returns {domain: set of ips} of the domains with a mapping last seen at or after since
+        """
+        return self.__query('domain', 'ip', domains, since)
+
+    def __query(self, key, value, keys, since):
+        keys = list(set(keys))
+        since = -float('inf') if since is None else since
+        result = {}
+        connection = self.__connect()
+        try:
+            for i in range(0, len(keys), SQLITE_BATCH):
+                batch = keys[i:i + SQLITE_BATCH]
+                rows = connection.execute('SELECT {0}, {1} FROM observations WHERE {0} IN ({2}) AND last_seen >= ?'
+                                          .format(key, value, ','.join('?' * len(batch))), batch + [since])
+                for row_key, row_value in rows:
+                    result.setdefault(row_key, set()).add(row_value)
+        finally:
+            connection.close()
+        return result
@@ -0,0 +1,141 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import math
+import os
+import numpy as np
+from .pcapng_reader import SectionInfo
+
+INDEX_SUFFIX = '.index.npz'
+INDEX_VERSION = 1
+# Packets between two checkpoints of the index
+INDEX_INTERVAL = 1024
+
+
+class TimeIndex:
+    """
+    Sidecar index of a pcapng file mapping frame times (ms) to block offsets. The packets are split in segments
+    of INDEX_INTERVAL packets, for every segment the offset of its first block, the section state at that
+    offset and the minimum and maximum frame time are kept. Timestamps do not have to be monotonic.
+    """
+    def __init__(self, offsets, min_times, max_times, sections):
+        self.offsets = offsets
+        self.min_times = min_times
+        self.max_times = max_times
+        self.sections = sections
+
+    def seek(self, min_time=-math.inf, max_time=math.inf):
+        """
+        Returns (start, end, SectionInfo at start) of the smallest block range holding every packet in the
+        window, end is None when reading has to continue to the end of the file, start is None when no packet
+        falls in the window.
+        """
+        after_start = np.flatnonzero(self.max_times >= min_time)
+        before_end = np.flatnonzero(self.min_times <= max_time)
+        if len(after_start) == 0 or len(before_end) == 0 or after_start[0] > before_end[-1]:
+            return None, None, None
+
+        first, last = after_start[0], before_end[-1]
+        end = int(self.offsets[last + 1]) if last + 1 < len(self.offsets) else None
+        return int(self.offsets[first]), end, self.sections[first]
+
+    @staticmethod
+    def path(pcap):
+        return pcap + INDEX_SUFFIX
+
+    @staticmethod
+    def signature(pcap):
+        stat = os.stat(pcap)
+        return np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    @classmethod
+    def load(cls, pcap):
+        """
+        Loads the sidecar index of the pcap, returns None when it is missing or outdated
+        """
+        try:
+            with np.load(cls.path(pcap), allow_pickle=False) as data:
+                if not np.array_equal(data['signature'], cls.signature(pcap)):
+                    return None
+
+                sections = []
+                for i, little_endian in enumerate(data['section_little_endian'].tolist()):
+                    section = SectionInfo(little_endian)
+                    selection = data['interface_section'] == i
+                    section.interfaces = list(zip(data['interface_linktype'][selection].tolist(),
+                                                  data['interface_divisor'][selection].tolist(),
+                                                  data['interface_tsoffset'][selection].tolist()))
+                    sections.append(section)
+
+                return cls(data['offsets'], data['min_times'], data['max_times'], sections)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def store(self, pcap):
+        """
+        Writes the sidecar index next to the pcap, silently skipped when that location is not writable
+        """
+        interfaces = [(i, interface) for i, section in enumerate(self.sections) for interface in section.interfaces]
+        try:
+            with open(self.path(pcap), 'wb') as f:
+                np.savez(f, signature=self.signature(pcap), offsets=self.offsets, min_times=self.min_times,
+                         max_times=self.max_times,
+                         section_little_endian=np.array([s.little_endian for s in self.sections], dtype=bool),
+                         interface_section=np.array([i for i, interface in interfaces], dtype=np.int64),
+                         interface_linktype=np.array([interface[0] for i, interface in interfaces], dtype=np.int64),
+                         interface_divisor=np.array([interface[1] for i, interface in interfaces], dtype=np.float64),
+                         interface_tsoffset=np.array([interface[2] for i, interface in interfaces], dtype=np.int64))
+        except OSError:
+            pass
+
+
+class TimeIndexBuilder:
+    """
+    Collects the checkpoints of a TimeIndex while PcapngReaders walk the complete file, the builders of
+    consecutive chunks are joined with extend
+    """
+    def __init__(self):
+        self.offsets = []
+        self.min_times = []
+        self.max_times = []
+        self.sections = []
+        self.count = 0
+
+    def add(self, offset, section, frame_time):
+        if self.count % INDEX_INTERVAL == 0:
+            self.offsets.append(offset)
+            self.min_times.append(frame_time)
+            self.max_times.append(frame_time)
+            self.sections.append(section.copy())
+        else:
+            self.min_times[-1] = min(self.min_times[-1], frame_time)
+            self.max_times[-1] = max(self.max_times[-1], frame_time)
+        self.count += 1
+
+    def extend(self, other):
+        self.offsets.extend(other.offsets)
+        self.min_times.extend(other.min_times)
+        self.max_times.extend(other.max_times)
+        self.sections.extend(other.sections)
+        self.count += other.count
+
+    def build(self):
+        return TimeIndex(np.array(self.offsets, dtype=np.int64), np.array(self.min_times, dtype=np.float64),
+                         np.array(self.max_times, dtype=np.float64), self.sections)
@@ -0,0 +1,234 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import os
+import struct
+
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_PB = 0x00000002
+BLOCK_EPB = 0x00000006
+
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_ENDOFOPT = 0
+OPT_IF_TSRESOL = 9
+OPT_IF_TSOFFSET = 14
+
+BLOCK_HEADER_LEN = 8
+# Interface id, timestamp high/low, captured and original length of enhanced and (obsolete) packet blocks
+PACKET_HEADER_LEN = 20
+
+
+class SectionInfo:
+    """
+    State needed to read the packet blocks of a pcapng section: the byte order and the interfaces
+    (link type, timestamp divisor, timestamp offset) described so far
+    """
+    def __init__(self, little_endian):
+        self.little_endian = little_endian
+        self.interfaces = []
+        prefix = '<' if little_endian else '>'
+        self.block_header = struct.Struct(prefix + 'II')
+        self.epb_header = struct.Struct(prefix + 'IIII')
+        self.pb_header = struct.Struct(prefix + 'HxxIII')
+        self.idb_header = struct.Struct(prefix + 'HxxI')
+        self.option_header = struct.Struct(prefix + 'HH')
+        self.tsoffset = struct.Struct(prefix + 'q')
+
+    def __getstate__(self):
+        return self.little_endian, self.interfaces
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+        self.interfaces = list(state[1])
+
+    def copy(self):
+        section = SectionInfo(self.little_endian)
+        section.interfaces = list(self.interfaces)
+        return section
+
+    def add_interface(self, body):
+        linktype, snaplen = self.idb_header.unpack_from(body, 0)
+        divisor = float(1e6)
+        tsoffset = 0
+
+        i = 8
+        while i + 4 <= len(body):
+            code, length = self.option_header.unpack_from(body, i)
+            value = body[i + 4:i + 4 + length]
+            if code == OPT_ENDOFOPT:
+                break
+            elif code == OPT_IF_TSRESOL and length >= 1:
+                # MSB 0: negative power of 10, MSB 1: negative power of 2
+                pow_num = 2 if value[0] & 0b10000000 else 10
+                divisor = float(pow_num ** (value[0] & 0b01111111))
+            elif code == OPT_IF_TSOFFSET and length >= 8:
+                tsoffset = self.tsoffset.unpack_from(value, 0)[0]
+            i += 4 + ((length + 3) & ~3)
+
+        self.interfaces.append((linktype, divisor, tsoffset))
+
+    def timestamp(self, interface_id, ts_high, ts_low):
+        linktype, divisor, tsoffset = self.interfaces[interface_id]
+        return tsoffset + (((ts_high << 32) | ts_low) / divisor)
+
+
+def section_from_header(buf):
+    """
+    Determines the byte order from the first 12 bytes of a section header block.
+    Returns the new SectionInfo and the length of the block.
+    """
+    if len(buf) < 12:
+        raise ValueError('invalid pcapng header')
+
+    if struct.unpack_from('<I', buf, 0)[0] != BLOCK_SHB:
+        raise ValueError('invalid pcapng header: not a SHB')
+
+    if struct.unpack_from('<I', buf, 8)[0] == BYTE_ORDER_MAGIC:
+        section = SectionInfo(True)
+    elif struct.unpack_from('>I', buf, 8)[0] == BYTE_ORDER_MAGIC:
+        section = SectionInfo(False)
+    else:
+        raise ValueError('unknown endianness')
+
+    return section, section.block_header.unpack_from(buf, 0)[1]
+
+
+def read_section_header(f):
+    """
+    Reads a section header block at the current position of f, returns the SectionInfo of that section
+    """
+    buf = f.read(12)
+    section, block_length = section_from_header(buf)
+    f.read(block_length - len(buf))
+    return section
+
+
+class PcapngReader:
+    """
+    Iterates the (timestamp, frame) pairs of a pcapng file like dpkt.pcapng.Reader, without building a
+    dpkt block object for every packet.
+    Given a start offset and the SectionInfo valid at that offset, it only reads the blocks in [start, end).
+    """
+    def __init__(self, fileobj, start=None, end=None, section=None):
+        self.f = fileobj
+        self.end = end
+
+        if start is None:
+            self.offset = 0
+        else:
+            self.offset = start
+            self.f.seek(start)
+        self.section = None if section is None else section.copy()
+
+    def blocks(self):
+        """
+        Yields (offset, block type, block body) for every block after the first section header, keeping the
+        section state up to date. Without a start offset, the file is read from its current position.
+        """
+        if self.section is None:
+            buf = self.f.read(12)
+            self.section, block_length = section_from_header(buf)
+            self.f.read(block_length - len(buf))
+            self.offset += block_length
+
+        while self.end is None or self.offset < self.end:
+            header = self.f.read(BLOCK_HEADER_LEN)
+            if len(header) < BLOCK_HEADER_LEN:
+                break
+
+            block_type, block_length = self.section.block_header.unpack(header)
+            if block_type == BLOCK_SHB:
+                # A new section, its byte order may differ
+                buf = header + self.f.read(4)
+                self.section, block_length = section_from_header(buf)
+                body = self.f.read(block_length - len(buf))
+            else:
+                if block_length < 12 or block_length % 4 != 0:
+                    raise ValueError('invalid pcapng block length {} at {}'.format(block_length, self.offset))
+                body = self.f.read(block_length - BLOCK_HEADER_LEN)
+                if len(body) < block_length - BLOCK_HEADER_LEN:
+                    break
+
+                if block_type == BLOCK_IDB:
+                    self.section.add_interface(body)
+
+            yield self.offset, block_type, body
+            self.offset += block_length
+
+    def __iter__(self):
+        for offset, block_type, body in self.blocks():
+            if block_type == BLOCK_EPB:
+                interface_id, ts_high, ts_low, captured_length = self.section.epb_header.unpack_from(body, 0)
+            elif block_type == BLOCK_PB:
+                interface_id, ts_high, ts_low, captured_length = self.section.pb_header.unpack_from(body, 0)
+            else:
+                continue
+
+            yield (self.section.timestamp(interface_id, ts_high, ts_low),
+                   body[PACKET_HEADER_LEN:PACKET_HEADER_LEN + captured_length])
+
+
+def scan_chunks(pcap, chunk_count):
+    """
+    Splits a pcapng file into block aligned byte ranges of roughly equal size, about chunk_count of them plus
+    one extra chunk for every further section in the file.
+    Returns a list of (start, end, SectionInfo at start), only the headers of packet blocks are read.
+    """
+    size = os.path.getsize(pcap)
+    target = size / chunk_count
+    chunks = []
+    with open(pcap, 'rb') as f:
+        section = read_section_header(f)
+        offset = chunk_start = f.tell()
+        chunk_section = section.copy()
+
+        while True:
+            header = f.read(12)
+            if len(header) < BLOCK_HEADER_LEN:
+                break
+
+            block_type, block_length = section.block_header.unpack_from(header, 0)
+            if block_type == BLOCK_SHB:
+                # Chunks never cross a section header, every chunk is read with a single SectionInfo
+                if offset > chunk_start:
+                    chunks.append((chunk_start, offset, chunk_section))
+                section, block_length = section_from_header(header)
+                chunk_start = offset + block_length
+                chunk_section = section.copy()
+            else:
+                if block_length < 12 or block_length % 4 != 0:
+                    raise ValueError('invalid pcapng block length {} at {}'.format(block_length, offset))
+
+                if offset - chunk_start >= target and len(chunks) < chunk_count - 1:
+                    chunks.append((chunk_start, offset, chunk_section))
+                    chunk_start = offset
+                    chunk_section = section.copy()
+
+                if block_type == BLOCK_IDB:
+                    section.add_interface(header[BLOCK_HEADER_LEN:] + f.read(block_length - len(header)))
+
+            offset += block_length
+            f.seek(offset)
+
+        if min(offset, size) > chunk_start:
+            chunks.append((chunk_start, min(offset, size), chunk_section))
+
+    return chunks
@@ -0,0 +1,197 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import math
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+
+# Seconds a cached host name, or a failed lookup, stays valid
+REVERSE_DNS_TTL = 7 * 24 * 3600
+NEGATIVE_TTL = 24 * 3600
+# Seconds after which a single lookup counts as failed
+LOOKUP_TIMEOUT = 2.0
+LOOKUP_THREADS = 32
+DNS_CACHE_NAME = 'reverse-dns.sqlite'
+# Parameters per query, below the SQLite limit of old versions
+SQLITE_BATCH = 500
+
+
+def gethostname(ip):
+    return socket.gethostbyaddr(ip)[0]
+
+
+class ReverseDNSCache:
+    """
+    SQLite table of the host names of IPs, shared by all runs and processes using the same file. A failed lookup is
+    stored with an empty host name. Entries older than their TTL are treated as missing and overwritten.
+    """
+    def __init__(self, path, ttl=REVERSE_DNS_TTL, negative_ttl=NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        with self.__connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS reverse_dns '
+                               '(ip TEXT PRIMARY KEY, hostname TEXT NOT NULL, resolved REAL NOT NULL)')
+
+    def __connect(self):
+        # Waits for the locks of other processes instead of failing
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, ips):
+        """
+        Returns {ip: host name or None for a failed lookup} of the ips with a valid entry
+        """
+        ips = list(ips)
+        now = time.time()
+        names = {}
+        connection = self.__connect()
+        try:
+            for i in range(0, len(ips), SQLITE_BATCH):
+                batch = ips[i:i + SQLITE_BATCH]
+                rows = connection.execute('SELECT ip, hostname, resolved FROM reverse_dns WHERE ip IN ({})'
+                                          .format(','.join('?' * len(batch))), batch)
+                for ip, hostname, resolved in rows:
+                    if now - resolved <= (self.ttl if len(hostname) > 0 else self.negative_ttl):
+                        names[ip] = hostname if len(hostname) > 0 else None
+        finally:
+            connection.close()
+        return names
+
+    def put_many(self, names):
+        now = time.time()
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.executemany('INSERT OR REPLACE INTO reverse_dns VALUES (?, ?, ?)',
+                                       [(ip, '' if hostname is None else hostname, now)
+                                        for ip, hostname in names.items()])
+        finally:
+            connection.close()
+
+
+class ReverseDNSResolver:
+    """
+    Resolves the reverse DNS names of many IPs at once. The IPs missing from the cache are looked up concurrently by
+    at most `threads` threads, a lookup that takes longer than `timeout` seconds counts as failed and its thread is
+    replaced. An abandoned thread takes no new IPs once its lookup returns, and no thread does after the batch ends,
+    at the latest when every lookup could have timed out one after the other on all threads (plus one timeout).
+    Host names and failed lookups are cached, timed out lookups are not, they are retried in a later run.
+    resolve_func(ip) returns the host name or raises OSError, e.g. a stub resolver instead of socket.gethostbyaddr.
+    """
+    def __init__(self, cache_path=None, timeout=LOOKUP_TIMEOUT, threads=LOOKUP_THREADS, resolve_func=gethostname,
+                 ttl=REVERSE_DNS_TTL, negative_ttl=NEGATIVE_TTL):
+        self.cache = None if cache_path is None else ReverseDNSCache(cache_path, ttl, negative_ttl)
+        self.timeout = timeout
+        self.threads = threads
+        self.resolve_func = resolve_func
+
+    @classmethod
+    def for_cache_dir(cls, cache_dir=None, **kwargs):
+        """
+        Resolver caching in the decoder cache directory, without a cache_dir nothing is kept after the run
+        """
+        if cache_dir is None:
+            return cls(**kwargs)
+        os.makedirs(cache_dir, exist_ok=True)
+        return cls(os.path.join(cache_dir, DNS_CACHE_NAME), **kwargs)
+
+    def resolve(self, ips):
+        """
+        Returns {ip: host name or None} for every distinct ip, None when the lookup failed or timed out
+        """
+        ips = set(ips)
+        names = {} if self.cache is None else self.cache.get_many(ips)
+        missing = [ip for ip in ips if ip not in names]
+        if len(missing) > 0:
+            looked_up = self.__lookup(missing)
+            if self.cache is not None:
+                self.cache.put_many(looked_up)
+            names.update(looked_up)
+            names.update((ip, None) for ip in missing if ip not in looked_up)
+        return names
+
+    def __lookup(self, ips):
+        """
+        Looks the ips up concurrently, returns {ip: host name or None} of the lookups that finished in time
+        """
+        tasks = queue.Queue()
+        for ip in ips:
+            tasks.put(ip)
+        events = queue.Queue()
+        done = threading.Event()
+        threads = min(self.threads, len(ips))
+        batch_deadline = time.monotonic() + self.timeout * (math.ceil(len(ips) / threads) + 1)
+        for _ in range(threads):
+            self.__start_worker(tasks, events, done)
+
+        names = {}
+        # ip -> (deadline, stop event of the thread looking it up)
+        deadlines = {}
+        remaining = len(ips)
+        try:
+            while remaining > 0:
+                wait = min([batch_deadline] + [deadline for deadline, stop in deadlines.values()]) - time.monotonic()
+                try:
+                    ip, started, name, stop = events.get(timeout=max(0.0, wait))
+                except queue.Empty:
+                    now = time.monotonic()
+                    if now >= batch_deadline:
+                        break
+                    for ip in [ip for ip, (deadline, stop) in deadlines.items() if deadline <= now]:
+                        # The stuck thread is abandoned, it is a daemon and does not keep the process alive
+                        deadlines.pop(ip)[1].set()
+                        remaining -= 1
+                        self.__start_worker(tasks, events, done)
+                    continue
+
+                if started is not None:
+                    deadlines[ip] = (started + self.timeout, stop)
+                elif ip in deadlines:
+                    del deadlines[ip]
+                    names[ip] = name
+                    remaining -= 1
+        finally:
+            done.set()
+            # Neither is anything left for a thread that checked done just before
+            while not tasks.empty():
+                tasks.get_nowait()
+
+        return names
+
+    def __start_worker(self, tasks, events, done):
+        threading.Thread(target=self.__work, args=(tasks, events, done, threading.Event()), daemon=True).start()
+
+    def __work(self, tasks, events, done, stop):
+        while not done.is_set() and not stop.is_set():
+            try:
+                ip = tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            events.put((ip, time.monotonic(), None, stop))
+            try:
+                name = self.resolve_func(ip)
+            except OSError:
+                name = None
+            events.put((ip, None, name, stop))
@@ -19,46 +19,76 @@
 # ---------------------------------------------------------------
 
 import dpkt
-import socket
+import math
+import os
 from .utils import inet_to_str
-import pandas as pd
-from enum import Enum
+from .trace_decoder import TraceDecoder
+from .packet_table import PacketTable, PacketDC, InternalPacketTypes
+from .capture_filter import CaptureFilter, PortDirection
+from .trace_cache import strings_to_array, array_to_strings
+from .passive_dns import PASSIVE_DNS_MAX_AGE
+from .ip_domain_map import IPDomainMap
+from .domain_rules import load_domain_rules
+import numpy as np
 
 
 DNS_PORT = 53
 TLS_HANDSHAKE = 22
 TLS_CLIENT_HELLO = 1
-
-
-class InternalPacketTypes(Enum):
-    DATA = 0
-    TLS_CLIENT_HELLO_SNI = 1
-
-
-class PacketDC(Enum):
-    SRC_IP = 'src_ip'
-    SRC_PORT = 'src_port'
-    DST_IP = 'dst_ip'
-    DST_PORT = 'dst_port'
-    FRAME_TIME = 'frame_time'
-    FRAME_LENGTH = 'frame_length'
-    PROTOCOL = 'protocol'
-    PACKET_TYPE = 'packet_type'
-    PACKET_TYPE_CONTENT = 'packet_type_content'
+BIGGER_PACKET_LENGTH = 1240
+# Time (ms) before the interesting minimum time from which a time bounded parse reads the packets, the DNS answers
+# and SNIs are read from the whole trace
+TIME_BOUND_LOOKBACK = 60000
+# Website guesses: traffic buckets (ms), traffic after an SNI (ms) and bytes needed to start a visit, time (ms)
+# between SNIs that ends a visit
+GUESS_BUCKET_SIZE = 1000
+GUESS_LOOK_AHEAD = 4000
+GUESS_MIN_LOAD = 50000
+GUESS_VISIT_GAP = 3000
+# Rules of the domains that are never a visited website
+AVOIDED_DOMAINS = os.path.join(os.path.dirname(__file__), 'rules', 'avoided_domains.txt')
 
 
 class SearchTrace:
-    def __init__(self, pcap):
+    def __init__(self, pcap, memory_budget=None, passive_dns=None, avoided_domains=AVOIDED_DOMAINS):
         self.pcap = pcap
+        self.avoided_domains = avoided_domains
         self.ips = set()
-        self.ip_domain_mapping = set()
+        self.ip_domain_mapping = IPDomainMap()
+        # (ip, domain) -> [first, last] frame time the trace showed the mapping
+        self.mapping_seen = {}
+        self.passive_dns = passive_dns
         self.minimum_time = 0
         self.google_packets = []
-        self.current_handling = None
-        self.packets = []
+        self.current_sni = None
+        self.packets = PacketTable(memory_budget)
         self.packets_df = None
+        self.bigger_ip_times = {}
+        self.start_time = None
+        # Only collect the DNS answers and SNIs, e.g. in the first pass of a run with the index
+        self.mappings_only = False
+
+    @property
+    def capture_filters(self):
+        if self.mappings_only:
+            return [CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], min_payload_length=1),
+                    CaptureFilter(protocols=[dpkt.ip.IP_PROTO_UDP], ports=[DNS_PORT], direction=PortDirection.SRC)]
+
+        # Only bounded by the start time, which is part of the cache key. The interesting minimum time is applied
+        # afterwards with bigger_ip_times, so a cached state holds for any minimum time.
+        return [CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], min_payload_length=1, min_time=self.start_time),
+                CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], min_ip_length=BIGGER_PACKET_LENGTH,
+                              min_time=self.start_time),
+                CaptureFilter(protocols=[dpkt.ip.IP_PROTO_UDP], ports=[DNS_PORT], direction=PortDirection.SRC,
+                              min_time=self.start_time)]
+
+    def get_packets_df(self, min_time=None):
+        """
+        With a minimum time, only the packets from that time on are returned, without loading earlier spilled packets
+        """
+        if min_time is not None:
+            return self.packets.window(min_time)
 
-    def get_packets_df(self):
         self._init_df()
         return self.packets_df
 
@@ -72,120 +102,173 @@ class SearchTrace:
         return self.google_packets
 
     def get_unrecognised_ips(self):
-        unreconised_ips = []
-        for ip in self.ips:
-            found = False
-            for ip_domain in self.ip_domain_mapping:
-                if ip == ip_domain[0]:
-                    found = True
-                    break
-            if not found:
-                unreconised_ips.append(ip)
-        return unreconised_ips
+        named = self.ip_domain_mapping.ip_set()
+        return [ip for ip in self.ips if ip not in named]
 
     def ip_to_domain(self, ip):
-        for ip_domain in self.ip_domain_mapping:
-            if ip_domain[0] == ip:
-                return ip_domain[1]
-
-        return None
-
-    def make_website_guess(self):
-        self._init_df()
-        guesses = []
-        length_group_size = 1000
-        agg_lens = self.packets_df.groupby(self.packets_df.frame_time // length_group_size * length_group_size)[PacketDC.FRAME_LENGTH.value].sum()
-        sni = self.packets_df.loc[self.packets_df[PacketDC.PACKET_TYPE.value] == InternalPacketTypes.TLS_CLIENT_HELLO_SNI.value]
-        sni.reset_index(inplace=True)
-        max_s = agg_lens.last_valid_index()
-
-        prev = None
-        prev_selected_but_filtered = False
-        visit_active = False
-        for i, row in sni.iterrows():
-            if row[PacketDC.FRAME_TIME.value] < self.minimum_time:
-                continue
-
-            next_len = 0
-            this_time = row[PacketDC.FRAME_TIME.value] // length_group_size * length_group_size
-            for j in range(int(this_time), int(min(this_time + 4000, max_s)), length_group_size):
-                if j in agg_lens.index:
-                    next_len += agg_lens[j]
-
-            # We suppose a user needs some seconds to skimm the page
-            interesting = self.__is_intersting_domain(row[PacketDC.PACKET_TYPE_CONTENT.value]) and 'google' not in row[PacketDC.PACKET_TYPE_CONTENT.value]
-            last_sni_is_long_ago = prev is None or row[PacketDC.FRAME_TIME.value] - prev[PacketDC.FRAME_TIME.value] > 3000
-
-            if last_sni_is_long_ago:
-                visit_active = False
-
-            if not visit_active and interesting and next_len > 50000:
-                guesses.append(
-                    (row[PacketDC.PACKET_TYPE_CONTENT.value], row[PacketDC.PACKET_TYPE_CONTENT.FRAME_TIME.value]))
-                visit_active = True
-
-            if interesting:
-                prev = row
-
-        return guesses
-
-    def parse(self):
-        for ts, buf in dpkt.pcapng.Reader(open(self.pcap, 'rb')):
-            eth = dpkt.ethernet.Ethernet(buf)
-            self.current_handling = {PacketDC.FRAME_TIME.value: ts * 1000,
-                                     PacketDC.PACKET_TYPE.value: InternalPacketTypes.DATA.value}
-
-            if self.__handle_ip(eth, ts):
-                self.packets.append(self.current_handling)
-
-        self.current_handling = None
+        return self.ip_domain_mapping.domain_of(ip)
+
+    def make_website_guess(self, min_time=None, max_time=None, bucket_size=GUESS_BUCKET_SIZE,
+                           look_ahead=GUESS_LOOK_AHEAD, min_load=GUESS_MIN_LOAD, visit_gap=GUESS_VISIT_GAP):
+        """
+        Guesses the visited websites from the SNIs in [min_time, max_time), by default from the interesting minimum
+        time on. An interesting SNI starts a visit when the traffic of the look_ahead ms after it exceeds min_load
+        bytes, a visit lasts until the next interesting SNI is more than visit_gap ms away.
+        """
+        min_time = self.minimum_time if min_time is None else min_time
+        max_time = math.inf if max_time is None else max_time
+        store = self.packets.time_store()
+        sni = self.packets.select(lambda df: df[PacketDC.PACKET_TYPE.value] == InternalPacketTypes.TLS_CLIENT_HELLO_SNI.value)
+        times = sni[PacketDC.FRAME_TIME.value].values
+        in_window = (times >= min_time) & (times < max_time)
+        times = times[in_window]
+        domains = sni[PacketDC.PACKET_TYPE_CONTENT.value].values[in_window]
+        if len(times) == 0:
+            return []
+
+        # Traffic of the buckets [this bucket, this bucket + look_ahead) before the last bucket
+        bucket_starts, bucket_lens = store.bucket_sums(bucket_size)
+        this_time = times // bucket_size * bucket_size
+        end_time = np.minimum(this_time + look_ahead, bucket_starts[-1])
+        next_len = store.bucket_sum_between(bucket_size, this_time, np.maximum(end_time, this_time))
+
+        # We suppose a user needs some seconds to skimm the page
+        verdicts = {domain: self.__is_intersting_domain(domain) and 'google' not in domain for domain in set(domains)}
+        interesting = np.fromiter((verdicts[domain] for domain in domains), dtype=bool, count=len(domains))
+
+        # A visit ends at every SNI long after the previous interesting SNI, within a visit only the first
+        # interesting SNI with enough traffic after it is a guess
+        rows = np.arange(len(times))
+        previous = np.maximum.accumulate(np.where(interesting, rows, -1))
+        previous = np.concatenate(([-1], previous[:-1]))
+        long_ago = (previous < 0) | (times - times[np.maximum(previous, 0)] > visit_gap)
+        visits = np.cumsum(long_ago)
+
+        candidates = np.flatnonzero(interesting & (next_len > min_load))
+        first_of_visit = np.diff(visits[candidates], prepend=-1) != 0
+        return [(domains[i], times[i]) for i in candidates[first_of_visit]]
+
+    def parse(self, cache_dir=None, workers=1, use_index=False):
+        """
+        With use_index and an interesting minimum time, only the packets from TIME_BOUND_LOOKBACK before that
+        time on are read, seeking with the TimeIndex of the trace. The DNS answers and SNIs of the whole trace are
+        still read, in a pass of their own unless the trace was already fed to a decoder with mappings_only.
+        """
+        if use_index and self.minimum_time > 0:
+            if not self.mappings_only:
+                self.mappings_only = True
+                TraceDecoder(self.pcap, cache_dir, workers, use_index).add_consumer(self).decode()
+            self.start_time = self.minimum_time - TIME_BOUND_LOOKBACK
+        self.mappings_only = False
+        TraceDecoder(self.pcap, cache_dir, workers, use_index).add_consumer(self).decode()
+        self.finish_parse()
+
+    def finish_parse(self):
+        """
+        Applies the filters that depend on the interesting minimum time, call after all packets are handled
+        """
+        if self.passive_dns is not None:
+            self.__exchange_passive_dns()
         self.__filter_out()
 
+    def __exchange_passive_dns(self):
+        """
+        Records the mappings of the trace in the passive DNS store and adds the stored domains of the IPs the trace
+        itself does not name
+        """
+        self.passive_dns.record((ip, domain, first, last) for (ip, domain), (first, last) in self.mapping_seen.items())
+        named = self.ip_domain_mapping.ip_set()
+        since = max(self.bigger_ip_times.values(), default=0) - PASSIVE_DNS_MAX_AGE
+        stored = self.passive_dns.domains_of(self.ips - named, since)
+        self.ip_domain_mapping.update((ip, domain) for ip, domains in stored.items() for domain in domains)
+
+    def cache_key(self):
+        if self.mappings_only:
+            return 'search-trace-mappings'
+        if self.start_time is not None:
+            return 'search-trace-from-{}'.format(int(self.start_time))
+        return 'search-trace'
+
+    def get_state(self):
+        ip_domains = sorted(self.ip_domain_mapping)
+        state = self.packets.get_state('packets_')
+        state['ips'] = strings_to_array(self.ips)
+        state['mapping_ips'] = strings_to_array(ip for ip, domain in ip_domains)
+        state['mapping_domains'] = strings_to_array(domain for ip, domain in ip_domains)
+        state['mapping_first'] = np.array([self.mapping_seen[ip_domain][0] for ip_domain in ip_domains],
+                                          dtype=np.float64)
+        state['mapping_last'] = np.array([self.mapping_seen[ip_domain][1] for ip_domain in ip_domains],
+                                         dtype=np.float64)
+        state['bigger_ips'] = strings_to_array(self.bigger_ip_times.keys())
+        state['bigger_times'] = np.fromiter(self.bigger_ip_times.values(), dtype=np.float64,
+                                            count=len(self.bigger_ip_times))
+        return state
+
+    def merge_state(self, state):
+        self.packets.merge_state(state, 'packets_')
+        self.ips.update(array_to_strings(state['ips']))
+        for ip, domain, first, last in zip(array_to_strings(state['mapping_ips']),
+                                           array_to_strings(state['mapping_domains']),
+                                           state['mapping_first'].tolist(), state['mapping_last'].tolist()):
+            self.__observe(ip, domain, first)
+            self.__observe(ip, domain, last)
+        for ip, time in zip(array_to_strings(state['bigger_ips']), state['bigger_times'].tolist()):
+            if self.bigger_ip_times.get(ip, -math.inf) < time:
+                self.bigger_ip_times[ip] = time
+
+    def handle_packet(self, packet):
+        if self.mappings_only:
+            self.__handle_mapping(packet)
+            return
+
+        self.__track_bigger(packet)
+        if self.__handle_ip(packet):
+            if self.current_sni is None:
+                self.packets.append(packet.frame_time, packet.src_ip, packet.src_port, packet.dst_ip,
+                                    packet.dst_port, packet.transport_length, packet.protocol)
+            else:
+                self.packets.append(packet.frame_time, packet.src_ip, packet.src_port, packet.dst_ip,
+                                    packet.dst_port, packet.transport_length, packet.protocol,
+                                    InternalPacketTypes.TLS_CLIENT_HELLO_SNI.value, self.current_sni)
+
+        self.current_sni = None
+
     def _init_df(self, force=False):
         if self.packets_df is None or force:
-            self.packets_df = pd.DataFrame(self.packets, columns=[e.value for e in PacketDC])
+            self.packets_df = self.packets.to_df()
 
     # --- HANDLE FUNCTIONS ---
     # Replies True if handled, false if not
-    def __handle_ip(self, eth, ts):
-        if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-            ip = eth.data
-            self.current_handling[PacketDC.SRC_IP.value] = inet_to_str(ip.src)
-            self.current_handling[PacketDC.DST_IP.value] = inet_to_str(ip.dst)
-            self.current_handling[PacketDC.FRAME_LENGTH.value] = len(ip.data)
-            self.current_handling[PacketDC.PROTOCOL.value] = ip.p
-
-            return self.__handle_tcp(ip, ts) or self.__handle_udp(ip)
+    def __handle_mapping(self, packet):
+        if packet.protocol == dpkt.ip.IP_PROTO_TCP:
+            # Only handshake records hold an SNI
+            if packet.frame[packet.payload_offset] == TLS_HANDSHAKE:
+                self.__handle_tls(packet, packet.dst_ip)
+            self.current_sni = None
         else:
-            return False
-
-    def __handle_tcp(self, ip, ts):
-        if ip.p == dpkt.ip.IP_PROTO_TCP:
-            tcp = ip.data
+            self.__handle_udp(packet)
 
-            ip_src = self.current_handling[PacketDC.SRC_IP.value]
-            ip_dst = self.current_handling[PacketDC.DST_IP.value]
-            self.ips.add(ip_src)
-            self.ips.add(ip_dst)
+    def __handle_ip(self, packet):
+        return self.__handle_tcp(packet) or self.__handle_udp(packet)
 
-            self.current_handling[PacketDC.SRC_PORT.value] = tcp.sport
-            self.current_handling[PacketDC.DST_PORT.value] = tcp.dport
-
-            return self.__handle_tls(tcp, ip_dst)
+    def __handle_tcp(self, packet):
+        if packet.protocol == dpkt.ip.IP_PROTO_TCP:
+            return self.__handle_tls(packet, packet.dst_ip)
             # Handled in kreep from now self.__handle_google(ip, ts)
         else:
             return False
 
-    def __handle_tls(self, tcp, ip_dst_str):
-        if len(tcp.data) <= 0:
+    def __handle_tls(self, packet, ip_dst_str):
+        if packet.payload_length <= 0:
             return False
 
+        payload = packet.payload
         try:
-            tls_records, i = dpkt.ssl.tls_multi_factory(tcp.data)
+            tls_records, i = dpkt.ssl.tls_multi_factory(payload)
         except (dpkt.ssl.SSL3Exception, dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
             return False
 
-        if i < len(tcp.data):
+        if i < len(payload):
             pass
 
         for record in tls_records:
@@ -199,84 +282,68 @@ class SearchTrace:
                     for tls_extension in tls_handshake.data.extensions:
                         if tls_extension[0] == 0:
                             domain_name = str.lower(tls_extension[1][5:].decode("ascii"))
-                            self.current_handling[PacketDC.PACKET_TYPE.value] =\
-                                InternalPacketTypes.TLS_CLIENT_HELLO_SNI.value
-                            self.current_handling[PacketDC.PACKET_TYPE_CONTENT.value] = domain_name
-                            self.ip_domain_mapping.add((ip_dst_str, domain_name))
+                            self.current_sni = domain_name
+                            self.__observe(ip_dst_str, domain_name, packet.frame_time)
 
         return True
 
-    def __handle_google(self, ip, ts):
-        tcp = ip.data
-
-        if len(tcp.data) <= 0 or not self.__is_from_google(ip.dst):
-            return False
-
-        self.google_packets.append((inet_to_str(ip.src) + ':' + tcp.sport, inet_to_str(ip.dst) + ':' + tcp.dport, ts*1000, len(tcp.data), ip.p))
-        return False # Returns False because not sure if from Google
-
-    def __handle_udp(self, ip):
-        if ip.p == dpkt.ip.IP_PROTO_UDP:
-            self.current_handling[PacketDC.SRC_PORT.value] = ip.data.sport
-            self.current_handling[PacketDC.DST_PORT.value] = ip.data.dport
-            return self.__handle_dns(ip.data)
+    def __handle_udp(self, packet):
+        if packet.protocol == dpkt.ip.IP_PROTO_UDP:
+            return self.__handle_dns(packet)
         else:
             return False
 
-    def __handle_dns(self, udp):
-        if udp.sport == 53:
+    def __handle_dns(self, packet):
+        if packet.src_port == DNS_PORT:
             try:
-                dns = dpkt.dns.DNS(udp.data)
+                dns = dpkt.dns.DNS(packet.payload)
             except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
                 return False
 
             for answer in dns.an:  # TODO Add CNAME?
                 if answer.type == dpkt.dns.DNS_A:
-                    self.ip_domain_mapping.add((inet_to_str(answer.ip), str.lower(answer.name)))
+                    self.__observe(inet_to_str(answer.ip), str.lower(answer.name), packet.frame_time)
                 elif answer.type == dpkt.dns.DNS_AAAA:
-                    self.ip_domain_mapping.add((inet_to_str(answer.ip6), str.lower(answer.name)))
+                    self.__observe(inet_to_str(answer.ip6), str.lower(answer.name), packet.frame_time)
             return True
         else:
             return False
 
-    def __filter_out(self):
-        ips_of_bigger = set()
-        for ts, buf in dpkt.pcapng.Reader(open(self.pcap, 'rb')):
-            eth = dpkt.ethernet.Ethernet(buf)
-
-            if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-                ip = eth.data
+    def __observe(self, ip, domain, frame_time):
+        self.ip_domain_mapping.add(ip, domain)
+        seen = self.mapping_seen.get((ip, domain))
+        if seen is None:
+            self.mapping_seen[(ip, domain)] = [frame_time, frame_time]
+        else:
+            seen[0] = min(seen[0], frame_time)
+            seen[1] = max(seen[1], frame_time)
+
+    def __track_bigger(self, packet):
+        # Keeps the latest time an ip was part of a bigger packet, so the minimum time can still be set afterwards.
+        # Only ips of bigger packets survive the filter, so only those are kept in ips.
+        if self.__is_interesting_ip(packet):
+            for ip in (packet.src_ip, packet.dst_ip):
+                self.ips.add(ip)
+                if self.bigger_ip_times.get(ip, -math.inf) < packet.frame_time:
+                    self.bigger_ip_times[ip] = packet.frame_time
 
-                if self.__is_interesting_ip(ip, ts * 1000):  # Definition of filter
-                    ips_of_bigger.add(inet_to_str(ip.src))
-                    ips_of_bigger.add(inet_to_str(ip.dst))
+    def __filter_out(self):
+        ips_of_bigger = set(ip for ip, time in self.bigger_ip_times.items() if time > self.minimum_time)
 
         self.ips = self.ips.intersection(ips_of_bigger)
 
-        for ip_domain in self.ip_domain_mapping:
-            if not self.__is_intersting_domain(ip_domain[1]):
-                try:
-                    self.ips.remove(ip_domain[0])
-                except KeyError:
-                    pass
+        interesting = set(domain for domain in self.ip_domain_mapping.domain_set()
+                          if self.__is_intersting_domain(domain))
+        for domain in self.ip_domain_mapping.domain_set() - interesting:
+            self.ips.difference_update(self.ip_domain_mapping.ips(domain))
 
-        self.ip_domain_mapping = [ip_domain for ip_domain in self.ip_domain_mapping if ip_domain[0] in ips_of_bigger
-                                  and self.__is_intersting_domain(ip_domain[1])]
+        self.ip_domain_mapping = self.ip_domain_mapping.restrict_ips(ips_of_bigger).filter_domains(
+            interesting.__contains__)
 
-    def __is_interesting_ip(self, ip, time):
+    def __is_interesting_ip(self, packet):
         # Tested package sizes
-        return ip.p == dpkt.ip.IP_PROTO_TCP and len(ip) >= 1240 and time > self.minimum_time
+        return packet.protocol == dpkt.ip.IP_PROTO_TCP and packet.ip_length >= BIGGER_PACKET_LENGTH
 
     def __is_intersting_domain(self, domain):
-        # Avoids certain computer domains
-        avoid_keywords = ["cdn", "static", "doubleclick", "api.", "cloudfront", "map.fastly.net", "googleapis.com",
-                          "code.jquery.com", "hit.gemius.pl", "akamaiedge.net", "dropbox.com", "hotjar.com",
-                          "opera.com", "s.section.io", "adobess.com", "omtrdc.net", "demdex.net", "adservice.google",
-                          "global.fastly.net", "hello.myfonts.net", "adobedtm.com", "ping.chartbeat.net",
-                          "drive.google.com", "resources.jetbrains.com", "js-agent.newrelic.com",
-                          "googletagmanager.com", "stackstorage.com", "mail.me.com", "ytimg.com", "mozilla.cloudflare-dns.com", "services.mozilla.com", "telemetry.mozilla.org"]
-        return not any(keyword in domain for keyword in avoid_keywords)
-
-    def __is_from_google(self, ip):
-        # TODO: Use OpenKnock? But does it work with IPv6?
-        return socket.gethostbyaddr(ip)[0].endswith('1e100.net')
+        # Avoids certain computer domains, the rules are loaded once per process
+        return not load_domain_rules(self.avoided_domains).matches(domain)
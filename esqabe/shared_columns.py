@@ -0,0 +1,117 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+from multiprocessing import shared_memory
+import numpy as np
+
+# Alignment (bytes) of every column in the shared block
+COLUMN_ALIGNMENT = 64
+# Blocks attached by this process, by name, reused by every handle of the same block
+ATTACHED = {}
+
+
+def attach(name):
+    block = ATTACHED.get(name)
+    if block is None:
+        try:
+            # Only the publishing process tracks (and removes) the block
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=name)
+        ATTACHED[name] = block
+    return block
+
+
+class SharedColumns:
+    """
+    Equally long NumPy columns published in a single multiprocessing.shared_memory block, so that the workers of a
+    process pool read one table instead of each receiving a pickled copy of it.
+    A pickled SharedColumns only holds the name of the block and the layout of the columns, unpickling attaches to
+    the block and gives read-only views without copying.
+    The publishing process owns the block and removes it on close(), or when used as context manager.
+    """
+    def __init__(self, block, layout, length, owner):
+        self.block = block
+        self.layout = layout
+        self.length = length
+        self.owner = owner
+        self.columns = {}
+        for name, (dtype, offset) in layout.items():
+            values = np.ndarray(length, dtype=np.dtype(dtype), buffer=block.buf, offset=offset)
+            values.flags.writeable = False
+            self.columns[name] = values
+
+    @classmethod
+    def publish(cls, columns):
+        """
+        Copies the columns (name -> 1-d array) into a new shared block
+        """
+        columns = {name: np.ascontiguousarray(values) for name, values in columns.items()}
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError('shared columns differ in length')
+
+        layout = {}
+        size = 0
+        for name, values in columns.items():
+            layout[name] = (values.dtype.str, size)
+            size += -(-values.nbytes // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+        # A shared block can not be empty
+        block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, values in columns.items():
+            np.ndarray(len(values), dtype=values.dtype, buffer=block.buf, offset=layout[name][1])[:] = values
+        return cls(block, layout, lengths.pop() if len(lengths) > 0 else 0, True)
+
+    def __getstate__(self):
+        return self.block.name, self.layout, self.length
+
+    def __setstate__(self, state):
+        name, layout, length = state
+        self.__init__(attach(name), layout, length, False)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def close(self):
+        """
+        Releases the views, the owner also removes the block
+        """
+        self.columns = {}
+        if self.owner:
+            try:
+                self.block.close()
+            except BufferError:
+                # Views still held elsewhere keep the mapping of this process alive until they are gone
+                pass
+            self.block.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,88 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import math
+import numpy as np
+
+
+class TimeStore:
+    """
+    Frame times (ms) and values (e.g. frame lengths) of packets, sorted once by time into contiguous arrays so that
+    windows, bucket sums and sessions are answered with searchsorted instead of scanning all packets.
+    order maps the sorted positions back to the original rows.
+    """
+    def __init__(self, times, values=None):
+        times = np.asarray(times, dtype=np.float64)
+        self.order = np.argsort(times, kind='stable')
+        self.times = times[self.order]
+        self.values = None if values is None else np.asarray(values)[self.order]
+        # bucket size -> (bucket starts, sums, prefix sums)
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def bounds(self, min_time=-math.inf, max_time=math.inf):
+        """
+        Sorted positions [start, end) of the packets with a frame time in [min_time, max_time]
+        """
+        return int(np.searchsorted(self.times, min_time, 'left')), int(np.searchsorted(self.times, max_time, 'right'))
+
+    def window(self, min_time=-math.inf, max_time=math.inf):
+        """
+        Original rows, ascending, of the packets with a frame time in [min_time, max_time]
+        """
+        start, end = self.bounds(min_time, max_time)
+        return np.sort(self.order[start:end])
+
+    def count_until(self, max_time):
+        return int(np.searchsorted(self.times, max_time, 'right'))
+
+    def bucket_sums(self, bucket_size):
+        """
+        (bucket starts, summed values) of the non-empty buckets of bucket_size ms, cached per bucket size
+        """
+        return self.__buckets(bucket_size)[:2]
+
+    def bucket_sum_between(self, bucket_size, starts, ends):
+        """
+        Summed values of the buckets starting in [starts, ends), vectorized over the arrays starts and ends
+        """
+        bucket_starts, sums, prefix_sums = self.__buckets(bucket_size)
+        return prefix_sums[np.searchsorted(bucket_starts, ends)] - prefix_sums[np.searchsorted(bucket_starts, starts)]
+
+    def __buckets(self, bucket_size):
+        if bucket_size not in self.buckets:
+            keys = self.times // bucket_size * bucket_size
+            firsts = np.flatnonzero(np.diff(keys, prepend=-math.inf) != 0)
+            sums = np.add.reduceat(self.values, firsts) if len(firsts) > 0 else np.zeros(0, dtype=self.values.dtype)
+            self.buckets[bucket_size] = (keys[firsts], sums, np.concatenate(([0], np.cumsum(sums))))
+        return self.buckets[bucket_size]
+
+    def sessions(self, gap, breaks=None):
+        """
+        Sorted positions [start, end) of the sessions: runs of packets at most gap ms apart that no time of the
+        sorted breaks separates
+        """
+        boundaries = np.diff(self.times) > gap
+        if breaks is not None:
+            boundaries |= np.diff(np.searchsorted(breaks, self.times)) != 0
+        starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1, [len(self.times)]))
+        return list(zip(starts[:-1].tolist(), starts[1:].tolist())) if len(self.times) > 0 else []
@@ -0,0 +1,106 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# Bump whenever the decoded output of the decoder or of a cacheable consumer changes
+DECODER_VERSION = 6
+HASH_BLOCK_SIZE = 1 << 20
+
+
+class TraceCache:
+    """
+    On-disk cache of decoded consumer state, stored as npz files keyed by the content hash of the trace, the
+    decoder version and the cache key of the consumer.
+    A cacheable consumer has cache_key(), get_state() returning a dict of NumPy arrays (or objects turned into one
+    by np.asarray) and merge_state(state) adding such a state to the consumer.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hashes = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def is_cacheable(consumer):
+        return hasattr(consumer, 'cache_key') and hasattr(consumer, 'get_state')
+
+    def content_hash(self, pcap):
+        stat = os.stat(pcap)
+        memo_key = (os.path.abspath(pcap), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self.hashes:
+            digest = hashlib.blake2b(digest_size=20)
+            with open(pcap, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    digest.update(block)
+            self.hashes[memo_key] = digest.hexdigest()
+        return self.hashes[memo_key]
+
+    def path(self, pcap, consumer):
+        name = '{}-v{}-{}.npz'.format(self.content_hash(pcap), DECODER_VERSION, consumer.cache_key())
+        return os.path.join(self.cache_dir, name)
+
+    def load(self, pcap, consumer):
+        """
+        Restores the fresh consumer from the cache, returns False when there is no valid entry. An entry missing keys
+        of the state of the consumer (written by another version, or by hand) is a miss, checked before anything is
+        merged.
+        """
+        path = self.path(pcap, consumer)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            data = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return False
+
+        # The arrays are read as the consumer merges them, not all at once
+        with data:
+            if not hasattr(data, 'files') or not set(consumer.get_state()).issubset(data.files):
+                return False
+            try:
+                consumer.merge_state(data)
+            except KeyError:
+                # Keys whose presence depends on the state itself are checked by merge_state before it changes the
+                # consumer, e.g. the parts of a PacketTable
+                return False
+        return True
+
+    def store(self, pcap, consumer):
+        path = self.path(pcap, consumer)
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **consumer.get_state())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+def strings_to_array(strings):
+    return np.array(list(strings), dtype=str)
+
+
+def array_to_strings(array):
+    return [str(value) for value in array]
@@ -0,0 +1,311 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import dpkt
+import pickle
+import socket
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from .utils import inet_to_str
+from .capture_filter import FilterSet
+from .trace_cache import TraceCache
+from .pcapng_reader import PcapngReader, scan_chunks
+from .pcapng_index import TimeIndex, TimeIndexBuilder
+from .compressed_input import compression_of, open_trace
+
+ETH_HEADER_LEN = 14
+IP4_HEADER_LEN = 20
+IP6_HEADER_LEN = 40
+TCP_HEADER_LEN = 20
+UDP_HEADER_LEN = 8
+
+# Precompiled header layouts, only the fields the consumers need
+ETH_TYPE = struct.Struct('!H')
+IP4_HEADER = struct.Struct('!BxHxxHxB')        # version/ihl, total length, flags/offset, protocol
+IP6_HEADER = struct.Struct('!4xHB')            # payload length, next header
+PORTS = struct.Struct('!HH')
+
+IP6_EXT_HDRS = frozenset(dpkt.ip6.EXT_HDRS)
+
+CHUNKS_PER_WORKER = 4
+
+
+class DecodedPacket:
+    """
+    A TCP or UDP packet as decoded once by the TraceDecoder and handed to every consumer.
+    The payload is only sliced out of the frame when a consumer asks for it.
+    """
+    __slots__ = ('frame_time', 'src_ip', 'dst_ip', 'protocol', 'src_port', 'dst_port', 'ip_length',
+                 'transport_length', 'payload_length', 'frame', 'payload_offset')
+
+    def __init__(self, frame_time, src_ip, dst_ip, protocol, src_port, dst_port, ip_length, transport_length,
+                 frame, payload_offset, payload_length):
+        self.frame_time = frame_time
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.protocol = protocol
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.ip_length = ip_length
+        self.transport_length = transport_length
+        self.frame = frame
+        self.payload_offset = payload_offset
+        self.payload_length = payload_length
+
+    @property
+    def payload(self):
+        return self.frame[self.payload_offset:self.payload_offset + self.payload_length]
+
+
+class FrameDecoder:
+    """
+    Reads the Ethernet/IPv4/IPv6/TCP/UDP header fields straight from the frame buffer. Frames the fast path
+    does not cover (802.3 and IPv6 extension headers) are handed to dpkt, so the result is the same as when
+    dpkt decodes every frame. The optional filter set is checked on the header fields before the packet is built.
+    """
+    def __init__(self, filter_set=None):
+        self.ip_strings = {}
+        self.filter_set = filter_set
+
+    def decode(self, ts, buf):
+        """
+        Decode an Ethernet frame into a DecodedPacket, returns None for anything that is not TCP or UDP over IP
+        """
+        if len(buf) < ETH_HEADER_LEN:
+            return None
+
+        eth_type, = ETH_TYPE.unpack_from(buf, 12)
+        if eth_type == dpkt.ethernet.ETH_TYPE_IP:
+            return self.__decode_ip4(ts, buf, ETH_HEADER_LEN)
+        elif eth_type == dpkt.ethernet.ETH_TYPE_IP6:
+            return self.__decode_ip6(ts, buf, ETH_HEADER_LEN)
+        elif eth_type <= 1500:
+            return self.__decode_dpkt(ts, buf)
+
+        # dpkt keeps the outer type for VLAN tagged and other frames, these were never analysed
+        return None
+
+    def ip_to_str(self, raw_ip):
+        ip = self.ip_strings.get(raw_ip)
+        if ip is None:
+            ip = socket.inet_ntop(socket.AF_INET6 if len(raw_ip) == 16 else socket.AF_INET, raw_ip)
+            self.ip_strings[raw_ip] = ip
+        return ip
+
+    def __decode_ip4(self, ts, buf, offset):
+        if len(buf) - offset < IP4_HEADER_LEN:
+            return None
+
+        v_hl, total_length, flags_offset, protocol = IP4_HEADER.unpack_from(buf, offset)
+        header_length = (v_hl & 0xf) << 2
+        if header_length < IP4_HEADER_LEN or flags_offset & dpkt.ip.IP_OFFMASK:
+            return None
+
+        end = min(offset + total_length, len(buf)) if total_length else len(buf)
+        data_offset = min(offset + header_length, len(buf))
+        end = max(end, data_offset)
+
+        return self.__decode_transport(ts, buf, protocol, offset + 12, 4, end - offset, data_offset, end)
+
+    def __decode_ip6(self, ts, buf, offset):
+        if len(buf) - offset < IP6_HEADER_LEN:
+            return None
+
+        payload_length, next_header = IP6_HEADER.unpack_from(buf, offset)
+        if next_header in IP6_EXT_HDRS:
+            return self.__decode_dpkt(ts, buf)
+
+        data_offset = offset + IP6_HEADER_LEN
+        end = min(data_offset + payload_length, len(buf)) if payload_length else len(buf)
+
+        return self.__decode_transport(ts, buf, next_header, offset + 8, 16, end - offset, data_offset, end)
+
+    def __decode_transport(self, ts, buf, protocol, address_offset, address_length, ip_length, offset, end):
+        length = end - offset
+        if protocol == dpkt.ip.IP_PROTO_TCP:
+            if length < TCP_HEADER_LEN:
+                return None
+            header_length = (buf[offset + 12] >> 4) << 2
+            if header_length < TCP_HEADER_LEN:
+                return None
+        elif protocol == dpkt.ip.IP_PROTO_UDP:
+            if length < UDP_HEADER_LEN:
+                return None
+            header_length = UDP_HEADER_LEN
+        else:
+            return None
+
+        src_port, dst_port = PORTS.unpack_from(buf, offset)
+        payload_offset = min(offset + header_length, end)
+        if self.filter_set is not None and not self.filter_set.matches(ts * 1000, protocol, src_port, dst_port,
+                                                                       ip_length, end - payload_offset):
+            return None
+
+        dst_offset = address_offset + address_length
+        src_ip = self.ip_to_str(buf[address_offset:dst_offset])
+        dst_ip = self.ip_to_str(buf[dst_offset:dst_offset + address_length])
+        return DecodedPacket(ts * 1000, src_ip, dst_ip, protocol, src_port, dst_port, ip_length, length,
+                             buf, payload_offset, end - payload_offset)
+
+    def __decode_dpkt(self, ts, buf):
+        try:
+            eth = dpkt.ethernet.Ethernet(buf)
+        except dpkt.dpkt.UnpackError:
+            return None
+        if eth.type != dpkt.ethernet.ETH_TYPE_IP and eth.type != dpkt.ethernet.ETH_TYPE_IP6:
+            return None
+
+        ip = eth.data
+        if ip.p == dpkt.ip.IP_PROTO_TCP and isinstance(ip.data, dpkt.tcp.TCP) or \
+                ip.p == dpkt.ip.IP_PROTO_UDP and isinstance(ip.data, dpkt.udp.UDP):
+            transport = ip.data
+            packet = DecodedPacket(ts * 1000, inet_to_str(ip.src), inet_to_str(ip.dst), ip.p, transport.sport,
+                                   transport.dport, len(ip), len(transport), transport.data, 0, len(transport.data))
+            if self.filter_set is None or self.filter_set.matches(packet.frame_time, packet.protocol,
+                                                                  packet.src_port, packet.dst_port,
+                                                                  packet.ip_length, packet.payload_length):
+                return packet
+
+        return None
+
+
+def is_mergeable(consumer):
+    return hasattr(consumer, 'get_state') and hasattr(consumer, 'merge_state')
+
+
+def decode_packets(frames, consumers):
+    """
+    Decodes the (timestamp, frame) pairs and hands the packets to the consumers whose filters they match
+    """
+    filter_set = FilterSet(consumers)
+    frame_decoder = FrameDecoder(filter_set)
+    for ts, buf in frames:
+        if not filter_set.matches_time(ts * 1000):
+            continue
+
+        packet = frame_decoder.decode(ts, buf)
+        if packet is None:
+            continue
+
+        for consumer in filter_set.consumers_for(packet):
+            consumer.handle_packet(packet)
+
+
+def indexed_frames(reader, index_builder):
+    """
+    Passes on the frames of the reader while adding every packet block to the TimeIndexBuilder
+    """
+    for ts, buf in reader:
+        index_builder.add(reader.offset, reader.section, ts * 1000)
+        yield ts, buf
+
+
+def decode_chunk(pcap, start, end, section, pickled_consumers, build_index=False):
+    """
+    Worker of the parallel decoder, returns the states of fresh copies of the consumers fed with one chunk and
+    the TimeIndexBuilder of the chunk when asked for
+    """
+    consumers = pickle.loads(pickled_consumers)
+    index_builder = TimeIndexBuilder() if build_index else None
+    with open(pcap, 'rb') as f:
+        reader = PcapngReader(f, start, end, section)
+        decode_packets(reader if index_builder is None else indexed_frames(reader, index_builder), consumers)
+    return [consumer.get_state() for consumer in consumers], index_builder
+
+
+class TraceDecoder:
+    """
+    Walks a pcapng trace a single time and hands every decoded packet to all registered consumers.
+    A consumer is any object with a handle_packet(packet) method. Consumers with a capture_filters list of
+    CaptureFilters only receive the packets matching at least one of them.
+    With a cache_dir, cacheable consumers are restored from the TraceCache and the trace is only read for the
+    consumers that were not cached yet.
+    With more than one worker, block aligned chunks of the trace are decoded in a process pool when all
+    consumers can merge states (get_state and merge_state). The states are merged in chunk order, so the
+    result is identical to a serial decode.
+    With use_index, a TimeIndex sidecar file is built on the first complete read of the trace. Later decodes
+    whose capture filters are bounded in time only read the blocks that can hold packets of that window.
+    Gzip, xz and zstd compressed traces are decompressed on the fly, they can not be seeked in so they are
+    always read serially and without index.
+    """
+    def __init__(self, pcap, cache_dir=None, workers=1, use_index=False):
+        self.pcap = pcap
+        self.consumers = []
+        self.cache = None if cache_dir is None else TraceCache(cache_dir)
+        self.compressed = compression_of(pcap) is not None
+        self.workers = 1 if self.compressed else workers
+        self.use_index = use_index and not self.compressed
+
+    def add_consumer(self, consumer):
+        self.consumers.append(consumer)
+        return self
+
+    def decode(self):
+        consumers = self.consumers
+        if self.cache is not None:
+            consumers = [c for c in consumers if not (self.cache.is_cacheable(c) and self.cache.load(self.pcap, c))]
+            if len(consumers) == 0:
+                return
+
+        start, end, section = None, None, None
+        index = TimeIndex.load(self.pcap) if self.use_index else None
+        if index is not None:
+            filter_set = FilterSet(consumers)
+            start, end, section = index.seek(filter_set.min_time, filter_set.max_time)
+        index_builder = TimeIndexBuilder() if self.use_index and index is None else None
+
+        # Without a start offset from the index no packet of the trace falls in the time window
+        if index is None or start is not None:
+            self.__read(consumers, start, end, section, index_builder)
+
+        if index_builder is not None:
+            index_builder.build().store(self.pcap)
+
+        if self.cache is not None:
+            for consumer in consumers:
+                if self.cache.is_cacheable(consumer):
+                    self.cache.store(self.pcap, consumer)
+
+    def __read(self, consumers, start, end, section, index_builder):
+        if self.workers > 1 and all(is_mergeable(consumer) for consumer in consumers):
+            self.__decode_parallel(consumers, start, end, index_builder)
+        else:
+            with open_trace(self.pcap) as f:
+                reader = PcapngReader(f, start, end, section)
+                decode_packets(reader if index_builder is None else indexed_frames(reader, index_builder),
+                               consumers)
+
+    def __decode_parallel(self, consumers, start=None, end=None, index_builder=None):
+        # Some more chunks than workers, to even out chunks with more interesting traffic
+        chunks = scan_chunks(self.pcap, self.workers * CHUNKS_PER_WORKER)
+        if start is not None:
+            chunks = [chunk for chunk in chunks if chunk[1] > start and (end is None or chunk[0] < end)]
+        pickled_consumers = pickle.dumps(consumers)
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(decode_chunk, self.pcap, chunk_start, chunk_end, section, pickled_consumers,
+                                   index_builder is not None)
+                       for chunk_start, chunk_end, section in chunks]
+            for future in futures:
+                states, chunk_index_builder = future.result()
+                for consumer, state in zip(consumers, states):
+                    consumer.merge_state(state)
+                if index_builder is not None:
+                    index_builder.extend(chunk_index_builder)
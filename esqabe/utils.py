@@ -35,11 +35,8 @@ def inet_to_str(inet):
     """Convert inet object to a string
         Source: https://dpkt.readthedocs.io/en/latest/_modules/examples/print_packets.html#mac_addr
     """
-    # First try ipv4 and then ipv6
-    try:
-        return socket.inet_ntop(socket.AF_INET, inet)
-    except ValueError:
-        return socket.inet_ntop(socket.AF_INET6, inet)
+    # IPv6 addresses are 16 bytes, IPv4 addresses 4
+    return socket.inet_ntop(socket.AF_INET6 if len(inet) == 16 else socket.AF_INET, inet)
 
 
 def is_from_wiki(domain):
@@ -18,6 +18,14 @@
 # Please cite the paper if you are using this source code.
 # ---------------------------------------------------------------
 
+from urllib.parse import urlsplit
+
+# Resource timing entries kept per document, by default the buffer only holds the first 250 resources of a page
+RESOURCE_TIMING_BUFFER = 100000
+# URLs of everything the page loaded, also the documents of its frames and the resources of third parties
+PAGE_RESOURCES_SCRIPT = "return performance.getEntriesByType('resource').map(function (entry) { return entry.name; });"
+
+
 def delete_cache(driver, browser):
     if browser == 'ff' or browser == 'firefox':
         print('[ERROR] Could not clear cache of FireFox. Use web profile.')
@@ -30,3 +38,38 @@ def delete_cache(driver, browser):
 def delete_cache_chrome(driver):
     driver.execute_cdp_cmd('Network.clearBrowserCache', {})
     print('Cleared chrome cache')
+
+
+def prepare_chrome(driver):
+    """
+    Makes every document of a new Chrome driver keep all its resource timing entries, for page_origins
+    """
+    driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument',
+                           {'source': 'performance.setResourceTimingBufferSize({});'.format(RESOURCE_TIMING_BUFFER)})
+
+
+def page_origins(driver):
+    """
+    The http(s) origins of the current page and of every resource it loaded
+    """
+    origins = []
+    for url in [driver.current_url] + list(driver.execute_script(PAGE_RESOURCES_SCRIPT) or []):
+        url = urlsplit(url)
+        origin = url.scheme + '://' + url.netloc
+        if url.scheme in ('http', 'https') and origin not in origins:
+            origins.append(origin)
+    return origins
+
+
+def reset_chrome(driver, blank_page='about:blank'):
+    """
+    Leaves a Chrome driver as if freshly started, on a blank page: the cookies of all sites and the cache cleared, and
+    the web storage of the page and of every origin it loaded resources from (frames, trackers, CDNs). Origins only
+    passed through by a redirect set nothing but cookies.
+    """
+    origins = page_origins(driver)
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+    for origin in origins:
+        driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+    driver.get(blank_page)
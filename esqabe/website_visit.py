@@ -20,16 +20,37 @@
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
-from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException
+from selenium.common.exceptions import NoSuchElementException, StaleElementReferenceException, TimeoutException, \
+    WebDriverException
+from concurrent.futures import ThreadPoolExecutor
+from .web_driver_utils import prepare_chrome, reset_chrome
+import queue
 import re
+import threading
+
+# Browsers of a BrowserPool, i.e. the websites visited at the same time
+BROWSER_POOL_SIZE = 4
+# Seconds a page may take to load, and a script to run, before the visit is given up
+VISIT_TIMEOUT = 30
+# Visits retried with a fresh browser when the browser crashed
+VISIT_RETRIES = 1
+
+
+def new_chrome():
+    options = Options()
+    options.headless = True
+    return webdriver.Chrome(options=options)
 
 
 class WebsiteVisit:
-    def __init__(self, url):
+    def __init__(self, url, driver=None):
+        """
+        Visit of the url in the given driver, e.g. one of a BrowserPool, or in a new headless Chrome that is quit by
+        end_session
+        """
         self.url = url
-        options = Options()
-        options.headless = True
-        self.driver = webdriver.Chrome(options=options)
+        self.owns_driver = driver is None
+        self.driver = new_chrome() if driver is None else driver
         self.interesting_meta_tags = ['name', 'description', 'og:site_name', 'og:title', 'og:description',
                                      'twitter:title', 'twitter:description']
 
@@ -94,7 +115,115 @@ class WebsiteVisit:
         return selected_terms
 
     def end_session(self):
-        self.driver.quit()
+        if self.owns_driver:
+            self.driver.quit()
+
+
+class BrowserPool:
+    """
+    Long-lived browsers shared by the website visits, started on first use and reused after their state is reset.
+    visit_all visits the urls concurrently, one per free browser. A browser that crashes is replaced and the visit
+    retried, a visit that does not load within visit_timeout gives None and its browser is replaced as well.
+    """
+    def __init__(self, size=BROWSER_POOL_SIZE, visit_timeout=VISIT_TIMEOUT, driver_factory=new_chrome):
+        self.size = size
+        self.visit_timeout = visit_timeout
+        self.driver_factory = driver_factory
+        self.drivers = []
+        self.lock = threading.Lock()
+        self.idle = None
+        self.__fill()
+
+    def __fill(self):
+        # Idle browsers, None for a slot without a started browser
+        self.idle = queue.Queue()
+        for i in range(self.size):
+            self.idle.put(None)
+
+    def __acquire(self):
+        driver = self.idle.get()
+        if driver is not None:
+            return driver
+
+        try:
+            driver = self.driver_factory()
+        except Exception:
+            self.idle.put(None)
+            raise
+        driver.set_page_load_timeout(self.visit_timeout)
+        driver.set_script_timeout(self.visit_timeout)
+        prepare_chrome(driver)
+        with self.lock:
+            self.drivers.append(driver)
+        return driver
+
+    def __discard(self, driver):
+        with self.lock:
+            self.drivers.remove(driver)
+        try:
+            quit_driver(driver)
+        finally:
+            self.idle.put(None)
+
+    def visit(self, url, action):
+        """
+        Result of action(WebsiteVisit) on the loaded url, None when the visit timed out or kept crashing
+        """
+        for attempt in range(VISIT_RETRIES + 1):
+            driver = self.__acquire()
+            try:
+                visit = WebsiteVisit(url, driver)
+                visit.start_session()
+                result = action(visit)
+            except TimeoutException:
+                print('Visit of', url, 'timed out')
+                self.__discard(driver)
+                return None
+            except WebDriverException as e:
+                print('Browser failed on', url, ':', e.msg)
+                self.__discard(driver)
+                continue
+            except BaseException:
+                # The state of the browser is unknown, its slot is freed for a new one before giving up
+                self.__discard(driver)
+                raise
+
+            try:
+                reset_chrome(driver)
+            except Exception:
+                self.__discard(driver)
+            else:
+                self.idle.put(driver)
+            return result
+        return None
+
+    def visit_all(self, urls, action):
+        """
+        Results of visit for all urls, in their order
+        """
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda url: self.visit(url, action), urls))
+
+    def close(self):
+        with self.lock:
+            drivers, self.drivers = self.drivers, []
+        for driver in drivers:
+            quit_driver(driver)
+        self.__fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def quit_driver(driver):
+    try:
+        driver.quit()
+    except WebDriverException:
+        # Already crashed
+        pass
 
 
 
@@ -22,8 +22,10 @@ import pandas as pd
 from .search_trace import PacketDC
 from .fingerprint_visitor import FingerprintVisitor
 from .wiki_trace import WikiTrace
+from .ip_domain_map import IPDomainMap
+from .time_store import TimeStore
 from .fingerprinting.classifiers.LiberatoreClassifier import LiberatoreClassifier
-import math
+import numpy as np
 import wikipedia
 import tempfile
 import re
@@ -35,18 +37,22 @@ HARD_WIKI_DISAMBIGUATION_LIMIT = 5
 
 
 class WikiFingerprintComparer:
-    def __init__(self) -> None:
+    def __init__(self, passive_dns=None) -> None:
         super().__init__()
         self.wiki_ips = []
+        self.passive_dns = passive_dns
 
     @staticmethod
     def is_from_wiki(domain):
         return any(wiki in domain for wiki in KNOWN_WIKI_NAMES)
 
     def feed_with_ip_domains(self, ip_domain_mapping):
-        for ip_domain in ip_domain_mapping:
-            if self.is_from_wiki(ip_domain[1]):
-                self.wiki_ips.append(ip_domain[0])
+        if not isinstance(ip_domain_mapping, IPDomainMap):
+            ip_domain_mapping = IPDomainMap(ip_domain_mapping)
+
+        for domain in ip_domain_mapping.domain_set():
+            if self.is_from_wiki(domain):
+                self.wiki_ips.extend(ip_domain_mapping.ips(domain))
 
     def add_wiki_ips(self, wiki_ips):
         self.wiki_ips.extend(wiki_ips)
@@ -94,7 +100,7 @@ class WikiFingerprintComparer:
                 id = id_pattern.sub('', page.split('/')[-1])
                 wiki_ips = set()
                 for cap in capture_files[page]:
-                    trace = WikiTrace(cap, page, id)
+                    trace = WikiTrace(cap, page, id, passive_dns=self.passive_dns)
                     trace.extend_wiki_ips(wiki_ips)
                     trace.parse()
                     wiki_ips = trace.wiki_ips
@@ -118,9 +124,10 @@ class WikiFingerprintComparer:
 
     def _filter_interesting(self, packets: pd.DataFrame, ts):
         poss_wiki_packets = packets[(packets[PacketDC.FRAME_TIME.value] >= ts) & (packets[PacketDC.DST_IP.value].isin(self.wiki_ips) | packets[PacketDC.SRC_IP.value].isin(self.wiki_ips))]
-        shifted = poss_wiki_packets[PacketDC.FRAME_TIME.value].shift(-1, fill_value=math.inf)
-        max_time = poss_wiki_packets[poss_wiki_packets[PacketDC.FRAME_TIME.value] + TIME_LOAD_UNTIL_CLICK < shifted][PacketDC.FRAME_TIME.value].iloc[0]
-        return poss_wiki_packets[poss_wiki_packets[PacketDC.FRAME_TIME.value] <= max_time]
+        # The page load ends at the first pause of more than TIME_LOAD_UNTIL_CLICK
+        store = TimeStore(poss_wiki_packets[PacketDC.FRAME_TIME.value].values)
+        start, end = store.sessions(TIME_LOAD_UNTIL_CLICK)[0]
+        return poss_wiki_packets.iloc[np.sort(store.order[start:end])]
 
     def _generate_wiki_urls(self, term, follow_disambiguation=True):
         try:
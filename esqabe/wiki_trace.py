@@ -20,8 +20,13 @@
 
 import dpkt
 from .utils import inet_to_str, is_from_wiki
-import pandas as pd
-from .search_trace import PacketDC
+from .packet_table import PacketTable, PacketDC
+from .trace_decoder import TraceDecoder
+from .capture_filter import CaptureFilter, PortDirection
+from .trace_cache import strings_to_array, array_to_strings
+from .passive_dns import PASSIVE_DNS_MAX_AGE
+from .ip_domain_map import IPDomainMap
+import numpy as np
 
 
 DNS_PORT = 53
@@ -30,15 +35,21 @@ TLS_CLIENT_HELLO = 1
 
 
 class WikiTrace:
-    def __init__(self, pcap, url, id):
+    def __init__(self, pcap, url, id, memory_budget=None, passive_dns=None):
         self.id = id
         self.url = url
         self.pcap = pcap
         self.wiki_ips = set()
-        self.ip_domain_mapping = set()
-        self.current_handling = None
-        self.packets = []
+        self.ip_domain_mapping = IPDomainMap()
+        # (ip, domain) -> [first, last] frame time the trace showed the mapping
+        self.mapping_seen = {}
+        self.passive_dns = passive_dns
+        self.packets = PacketTable(memory_budget)
         self.packets_df = None
+        self.capture_filters = [
+            CaptureFilter(protocols=[dpkt.ip.IP_PROTO_TCP], min_payload_length=1),
+            CaptureFilter(protocols=[dpkt.ip.IP_PROTO_UDP], ports=[DNS_PORT], direction=PortDirection.SRC)
+        ]
 
     def get_packets_df(self):
         self._init_df()
@@ -48,26 +59,58 @@ class WikiTrace:
         return self.ip_domain_mapping
 
     def ip_to_domain(self, ip):
-        for ip_domain in self.ip_domain_mapping:
-            if ip_domain[0] == ip:
-                return ip_domain[1]
-
-        return None
+        return self.ip_domain_mapping.domain_of(ip)
 
     def extend_wiki_ips(self, ips):
         self.wiki_ips.update(ips)
 
-    def parse(self):
-        for ts, buf in dpkt.pcapng.Reader(open(self.pcap, 'rb')):
-            eth = dpkt.ethernet.Ethernet(buf)
-            self.current_handling = {PacketDC.FRAME_TIME.value: ts * 1000}
-
-            if self.__handle_ip(eth, ts):
-                self.packets.append(self.current_handling)
-
-        self.current_handling = None
+    def parse(self, workers=1):
+        TraceDecoder(self.pcap, workers=workers).add_consumer(self).decode()
+        if self.passive_dns is not None:
+            self.__exchange_passive_dns()
         self.__filter_out()
 
+    def __exchange_passive_dns(self):
+        """
+        Records the Wikipedia mappings of the trace in the passive DNS store and adds the IPs of the trace that the
+        store knows as Wikipedia
+        """
+        self.passive_dns.record((ip, domain, first, last) for (ip, domain), (first, last) in self.mapping_seen.items())
+        times = self.packets.column(PacketDC.FRAME_TIME)
+        since = (times.max() if len(times) > 0 else 0) - PASSIVE_DNS_MAX_AGE
+        stored = self.passive_dns.domains_of(set(self.packets.ip_lookup) - self.wiki_ips, since)
+        for ip, domains in stored.items():
+            for domain in domains:
+                if is_from_wiki(domain):
+                    self.ip_domain_mapping.add(ip, domain)
+                    self.wiki_ips.add(ip)
+
+    def get_state(self):
+        ip_domains = sorted(self.ip_domain_mapping)
+        state = self.packets.get_state('packets_')
+        state['wiki_ips'] = strings_to_array(self.wiki_ips)
+        state['mapping_ips'] = strings_to_array(ip for ip, domain in ip_domains)
+        state['mapping_domains'] = strings_to_array(domain for ip, domain in ip_domains)
+        state['mapping_first'] = np.array([self.mapping_seen[ip_domain][0] for ip_domain in ip_domains],
+                                          dtype=np.float64)
+        state['mapping_last'] = np.array([self.mapping_seen[ip_domain][1] for ip_domain in ip_domains],
+                                         dtype=np.float64)
+        return state
+
+    def merge_state(self, state):
+        self.packets.merge_state(state, 'packets_')
+        self.wiki_ips.update(array_to_strings(state['wiki_ips']))
+        for ip, domain, first, last in zip(array_to_strings(state['mapping_ips']),
+                                           array_to_strings(state['mapping_domains']),
+                                           state['mapping_first'].tolist(), state['mapping_last'].tolist()):
+            self.__observe(ip, domain, first)
+            self.__observe(ip, domain, last)
+
+    def handle_packet(self, packet):
+        if self.__handle_ip(packet):
+            self.packets.append(packet.frame_time, packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port,
+                                packet.transport_length, packet.protocol)
+
     def insert_df(self, df):
         self.packets_df = df
 
@@ -97,46 +140,30 @@ class WikiTrace:
 
     def _init_df(self, force=False):
         if self.packets_df is None or force:
-            self.packets_df = pd.DataFrame(self.packets, columns=[e.value for e in PacketDC])
+            self.packets_df = self.packets.to_df()
 
     # --- HANDLE FUNCTIONS ---
     # Replies True if handled, false if not
-    def __handle_ip(self, eth, ts):
-        if eth.type == dpkt.ethernet.ETH_TYPE_IP or eth.type == dpkt.ethernet.ETH_TYPE_IP6:
-            ip = eth.data
-            self.current_handling[PacketDC.SRC_IP.value] = inet_to_str(ip.src)
-            self.current_handling[PacketDC.DST_IP.value] = inet_to_str(ip.dst)
-            self.current_handling[PacketDC.FRAME_LENGTH.value] = len(ip.data)
-            self.current_handling[PacketDC.PROTOCOL.value] = ip.p
-
-            return self.__handle_tcp(ip, ts) or self.__handle_udp(ip)
-        else:
-            return False
+    def __handle_ip(self, packet):
+        return self.__handle_tcp(packet) or self.__handle_udp(packet)
 
-    def __handle_tcp(self, ip, ts):
-        if ip.p == dpkt.ip.IP_PROTO_TCP:
-            tcp = ip.data
-
-            ip_src = self.current_handling[PacketDC.SRC_IP.value]
-            ip_dst = self.current_handling[PacketDC.DST_IP.value]
-
-            self.current_handling[PacketDC.SRC_PORT.value] = tcp.sport
-            self.current_handling[PacketDC.DST_PORT.value] = tcp.dport
-
-            return self.__handle_tls(tcp, ip_dst, ip_src)
+    def __handle_tcp(self, packet):
+        if packet.protocol == dpkt.ip.IP_PROTO_TCP:
+            return self.__handle_tls(packet, packet.dst_ip, packet.src_ip)
         else:
             return False
 
-    def __handle_tls(self, tcp, ip_dst_str, ip_src_str):
-        if len(tcp.data) <= 0:
+    def __handle_tls(self, packet, ip_dst_str, ip_src_str):
+        if packet.payload_length <= 0:
             return False
 
+        payload = packet.payload
         try:
-            tls_records, i = dpkt.ssl.tls_multi_factory(tcp.data)
+            tls_records, i = dpkt.ssl.tls_multi_factory(payload)
         except (dpkt.ssl.SSL3Exception, dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
             return False
 
-        if i < len(tcp.data):
+        if i < len(payload):
             pass
 
         for record in tls_records:
@@ -151,39 +178,45 @@ class WikiTrace:
                         if tls_extension[0] == 0:
                             domain_name = str.lower(tls_extension[1][5:].decode("ascii"))
                             if is_from_wiki(domain_name):
-                                self.ip_domain_mapping.add((ip_dst_str, domain_name))
+                                self.__observe(ip_dst_str, domain_name, packet.frame_time)
                                 self.wiki_ips.add(ip_dst_str)
 
         return True
 
-    def __handle_udp(self, ip):
-        if ip.p == dpkt.ip.IP_PROTO_UDP:
-            self.current_handling[PacketDC.SRC_PORT.value] = ip.data.sport
-            self.current_handling[PacketDC.DST_PORT.value] = ip.data.dport
-            return self.__handle_dns(ip.data)
+    def __handle_udp(self, packet):
+        if packet.protocol == dpkt.ip.IP_PROTO_UDP:
+            return self.__handle_dns(packet)
         else:
             return False
 
-    def __handle_dns(self, udp):
-        if udp.sport == 53:
+    def __handle_dns(self, packet):
+        if packet.src_port == DNS_PORT:
             try:
-                dns = dpkt.dns.DNS(udp.data)
+                dns = dpkt.dns.DNS(packet.payload)
             except (dpkt.dpkt.NeedData, dpkt.dpkt.UnpackError):
                 return False
 
             for answer in dns.an:  # TODO Add CNAME?
                 if answer.type == dpkt.dns.DNS_A and is_from_wiki(str.lower(answer.name)):
-                    self.ip_domain_mapping.add((inet_to_str(answer.ip), str.lower(answer.name)))
+                    self.__observe(inet_to_str(answer.ip), str.lower(answer.name), packet.frame_time)
                     self.wiki_ips.add(inet_to_str(answer.ip))
                 elif answer.type == dpkt.dns.DNS_AAAA and is_from_wiki(str.lower(answer.name)):
-                    self.ip_domain_mapping.add((inet_to_str(answer.ip6), str.lower(answer.name)))
+                    self.__observe(inet_to_str(answer.ip6), str.lower(answer.name), packet.frame_time)
                     self.wiki_ips.add(inet_to_str(answer.ip6))
             return True
         else:
             return False
 
+    def __observe(self, ip, domain, frame_time):
+        self.ip_domain_mapping.add(ip, domain)
+        seen = self.mapping_seen.get((ip, domain))
+        if seen is None:
+            self.mapping_seen[(ip, domain)] = [frame_time, frame_time]
+        else:
+            seen[0] = min(seen[0], frame_time)
+            seen[1] = max(seen[1], frame_time)
+
     def __filter_out(self):
-        self._init_df()
-        self.packets_df = self.packets_df[self.packets_df[PacketDC.DST_IP.value].isin(self.wiki_ips) | self.packets_df[PacketDC.SRC_IP.value].isin(self.wiki_ips)]
+        self.packets_df = self.packets.select(lambda df: df[PacketDC.DST_IP.value].isin(self.wiki_ips) | df[PacketDC.SRC_IP.value].isin(self.wiki_ips))
 
 
@@ -20,7 +20,9 @@
 
 import argparse
 import sys
-from esqabe import esqabe
+from esqabe import esqabe, esqabe_live, esqabe_sessions
+from esqabe.search_trace import AVOIDED_DOMAINS
+from esqabe.website_visit import BROWSER_POOL_SIZE, VISIT_TIMEOUT
 
 
 def main():
@@ -32,10 +34,43 @@ def main():
 
     parser = argparse.ArgumentParser(prog='ESQABE', description='Determine what was Googled from a Wireshark'
                                                                        ' capture where HTTPS was used!')
-    parser.add_argument('pcapng', type=str, help='filename of the pcapng trace')
+    parser.add_argument('pcapng', type=str, help='filename of the pcapng trace, - for stdin in live mode')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='directory to cache the decoded trace in, speeds up repeated runs on the same trace')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes decoding chunks of the trace in parallel')
+    parser.add_argument('--index', dest='use_index', action='store_true',
+                        help='keep a time index next to the trace and only read the part of the trace after the search')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='memory (MB) for the packets of the trace, beyond it they are spilled to temporary files')
+    parser.add_argument('--reverse-dns', action='store_true',
+                        help='look up the reverse DNS name of IPs outside the known prefixes of the search engine, '
+                             'needs network access')
+    parser.add_argument('--passive-dns', type=str, default=None,
+                        help='SQLite file collecting the IP to domain mappings of all analysed traces, used for the IPs '
+                             'a trace does not name itself')
+    parser.add_argument('--browsers', type=int, default=BROWSER_POOL_SIZE,
+                        help='number of browsers visiting the guessed websites at the same time')
+    parser.add_argument('--visit-timeout', type=int, default=VISIT_TIMEOUT,
+                        help='seconds a guessed website may take to load before its visit is given up')
+    parser.add_argument('--avoided-domains', type=str, default=AVOIDED_DOMAINS,
+                        help='rules file of the domains (CDNs, trackers, ...) that are never a visited website')
 
-    args = parser.parse_args(args)
-    esqabe(**vars(args))
+    parser.add_argument('--live', action='store_true',
+                        help='follow a trace that is still being captured (stdin or a named pipe) and print the '
+                             'search pattern as soon as keystrokes are detected')
+    parser.add_argument('--sessions', action='store_true',
+                        help='find every search in the trace and print the pattern and website guesses of each')
+
+    args = vars(parser.parse_args(args))
+    live, sessions = args.pop('live'), args.pop('sessions')
+    browsers, visit_timeout = args.pop('browsers'), args.pop('visit_timeout')
+    if live:
+        esqabe_live(args['pcapng'], args['reverse_dns'], args['passive_dns'])
+    elif sessions:
+        esqabe_sessions(**args)
+    else:
+        esqabe(**args, browsers=browsers, visit_timeout=visit_timeout)
 
 
 if __name__ == '__main__':
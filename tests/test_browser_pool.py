@@ -0,0 +1,153 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import re
+import threading
+import unittest
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from esqabe.website_visit import BrowserPool
+
+
+class FakeDriver:
+    """
+    Stand-in for a Chrome driver, pages whose url contains 'slow' time out and those containing 'crash' crash the
+    browser
+    """
+    def __init__(self):
+        self.current_url = 'about:blank'
+        self.quit_called = False
+        self.cdp_commands = []
+
+    def set_page_load_timeout(self, timeout):
+        pass
+
+    def set_script_timeout(self, timeout):
+        pass
+
+    def get(self, url):
+        if 'slow' in url:
+            raise TimeoutException('slow')
+        if 'crash' in url:
+            raise WebDriverException('crashed')
+        self.current_url = url
+
+    def execute_script(self, script):
+        # The resources a page loads: one of its own, one from a CDN and an inline image
+        if self.current_url == 'about:blank':
+            return []
+        return [self.current_url + '/app.js', 'https://cdn.example.net/lib.js', 'data:image/png;base64,AAAA']
+
+    def execute_cdp_cmd(self, command, params):
+        # Chrome rejects unknown parameters and origins that are not scheme://host
+        if command == 'Storage.clearDataForOrigin' and \
+                (set(params) != {'origin', 'storageTypes'} or not re.fullmatch(r'https?://[^/*]+', params['origin'])):
+            raise WebDriverException('Invalid parameters')
+        self.cdp_commands.append((command, params))
+
+    def quit(self):
+        self.quit_called = True
+
+
+class FakeFactory:
+    def __init__(self):
+        self.drivers = []
+
+    def __call__(self):
+        driver = FakeDriver()
+        self.drivers.append(driver)
+        return driver
+
+
+def run_with_deadline(test, function, deadline=10):
+    """
+    Result of function(), fails the test instead of hanging when it does not return before the deadline
+    """
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = function()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(deadline)
+    test.assertFalse(thread.is_alive(), 'visits did not finish')
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+class BrowserPoolTest(unittest.TestCase):
+    def test_failing_action_frees_its_browser(self):
+        factory = FakeFactory()
+        pool = BrowserPool(2, driver_factory=factory)
+
+        def action(visit):
+            raise AttributeError('find_element_by_tag_name')
+
+        urls = ['a.com', 'b.com', 'c.com', 'd.com']
+        with self.assertRaises(AttributeError):
+            run_with_deadline(self, lambda: pool.visit_all(urls, action))
+        self.assertEqual(pool.drivers, [])
+        self.assertTrue(all(driver.quit_called for driver in factory.drivers))
+
+        # The slots are free again for later visits
+        results = run_with_deadline(self, lambda: pool.visit_all(urls, lambda visit: visit.driver.current_url))
+        self.assertEqual(results, ['http://' + url for url in urls])
+        pool.close()
+
+    def test_browser_is_reused_after_reset(self):
+        factory = FakeFactory()
+        with BrowserPool(1, driver_factory=factory) as pool:
+            results = run_with_deadline(self, lambda: pool.visit_all(['a.com', 'b.com', 'c.com'],
+                                                                      lambda visit: visit.driver.current_url))
+            self.assertEqual(results, ['http://a.com', 'http://b.com', 'http://c.com'])
+            # A single warm browser did all visits and went back to the idle queue after each of them
+            self.assertEqual(len(factory.drivers), 1)
+            self.assertEqual(pool.drivers, factory.drivers)
+            self.assertIs(pool.idle.get_nowait(), factory.drivers[0])
+
+        driver = factory.drivers[0]
+        commands = [command for command, params in driver.cdp_commands]
+        self.assertEqual(commands[0], 'Page.addScriptToEvaluateOnNewDocument')
+        # The cookies of all sites go after each visit, the storage of the page and of the origins it loaded from too
+        self.assertEqual(commands.count('Network.clearBrowserCookies'), 3)
+        self.assertEqual([params['origin'] for command, params in driver.cdp_commands
+                          if command == 'Storage.clearDataForOrigin'],
+                         ['http://a.com', 'https://cdn.example.net', 'http://b.com', 'https://cdn.example.net',
+                          'http://c.com', 'https://cdn.example.net'])
+        self.assertEqual(driver.current_url, 'about:blank')
+
+    def test_timeout_and_crash_replace_the_browser(self):
+        factory = FakeFactory()
+        with BrowserPool(2, driver_factory=factory) as pool:
+            results = run_with_deadline(self, lambda: pool.visit_all(['slow.com', 'crash.com', 'a.com'],
+                                                                      lambda visit: visit.driver.current_url))
+            self.assertEqual(results, [None, None, 'http://a.com'])
+            # Every failed browser was quit and left the pool, which of them depends on the order of the visits
+            self.assertEqual(pool.drivers, [driver for driver in factory.drivers if not driver.quit_called])
+            self.assertGreaterEqual(len(factory.drivers) - len(pool.drivers), 3)
+        self.assertTrue(all(driver.quit_called for driver in factory.drivers))
+
+
+if __name__ == '__main__':
+    unittest.main()
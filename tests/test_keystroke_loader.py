@@ -0,0 +1,131 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import os
+import socket
+import struct
+import tempfile
+import unittest
+import dpkt
+from esqabe.host_evidence import HostEvidence
+from esqabe.kreep.util import EngineClassifier, load_pcap
+from esqabe.reverse_dns import ReverseDNSResolver
+
+CLIENT = '192.168.1.10'
+# www.google.com, outside the published prefixes of google
+ENGINE_IP = '203.0.113.7'
+
+
+def frame(src, dst, protocol, segment):
+    ip = dpkt.ip.IP(src=socket.inet_aton(src), dst=socket.inet_aton(dst), p=protocol, data=segment)
+    ip.len = len(bytes(ip))
+    return bytes(dpkt.ethernet.Ethernet(src=b'\x01' * 6, dst=b'\x02' * 6, type=dpkt.ethernet.ETH_TYPE_IP, data=ip))
+
+
+def tcp(src, dst, sport, dport, payload):
+    return frame(src, dst, dpkt.ip.IP_PROTO_TCP, dpkt.tcp.TCP(sport=sport, dport=dport, data=payload,
+                                                              flags=dpkt.tcp.TH_ACK))
+
+
+def dns_response(name, ip):
+    dns = dpkt.dns.DNS(id=1, qr=1, op=dpkt.dns.DNS_RA)
+    dns.qd = [dpkt.dns.DNS.Q(name=name, type=dpkt.dns.DNS_A)]
+    dns.an = [dpkt.dns.DNS.RR(name=name, type=dpkt.dns.DNS_A, cls=1, ttl=60, ip=socket.inet_aton(ip))]
+    udp = dpkt.udp.UDP(sport=53, dport=40000, data=bytes(dns))
+    udp.ulen = len(bytes(udp))
+    return frame('8.8.8.8', CLIENT, dpkt.ip.IP_PROTO_UDP, udp)
+
+
+def client_hello(name):
+    name = name.encode()
+    sni = struct.pack('>HBH', len(name) + 3, 0, len(name)) + name
+    extensions = struct.pack('>HH', 0, len(sni)) + sni
+    body = b'\x03\x03' + b'\x00' * 33 + b'\x00\x02\x13\x01\x01\x00' + struct.pack('>H', len(extensions)) + extensions
+    handshake = b'\x01' + struct.pack('>I', len(body))[1:] + body
+    return b'\x16\x03\x01' + struct.pack('>H', len(handshake)) + handshake
+
+
+def app_data(length):
+    return b'\x17\x03\x03' + struct.pack('>H', length) + b'\xaa' * length
+
+
+class KeystrokeLoaderTest(unittest.TestCase):
+    KEYSTROKES = 18
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.pcap = os.path.join(cls.directory.name, 'named-engine.pcapng')
+        time = 1600000000.0
+        packets = [(time, dns_response('www.google.com', ENGINE_IP)),
+                   (time + 0.01, tcp(CLIENT, ENGINE_IP, 50001, 443, client_hello('www.google.com')))]
+        # Far enough from the keystrokes to end up in other chunks of a parallel decode
+        for i in range(20000):
+            time += 0.001
+            packets.append((time, tcp('10.0.0.{}'.format(i % 50 + 1), CLIENT, 443, 40000 + i % 50, b'x' * 200)))
+        for k in range(cls.KEYSTROKES):
+            time += 0.3
+            packets.append((time, tcp(CLIENT, ENGINE_IP, 50001, 443, app_data(120 + k))))
+            packets.append((time + 0.05, tcp(ENGINE_IP, CLIENT, 443, 50001, app_data(800))))
+
+        with open(cls.pcap, 'wb') as f:
+            writer = dpkt.pcapng.Writer(f)
+            for time, packet in packets:
+                writer.writepkt(packet, ts=time)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assertFramesEqual(self, expected, frames):
+        for expected_df, df in zip(expected, frames):
+            self.assertTrue(expected_df.reset_index(drop=True).equals(df.reset_index(drop=True)))
+
+    def test_parallel_decode_uses_the_names_of_the_whole_trace(self):
+        for memory_budget in (None, 1 << 20):
+            serial = load_pcap(self.pcap, 'google', memory_budget=memory_budget)
+            self.assertEqual(len(serial[0]), self.KEYSTROKES)
+            self.assertEqual(set(serial[0]['dst']), {ENGINE_IP + ':443'})
+            self.assertGreater(len(serial[1]), 0)
+            self.assertFramesEqual(serial, load_pcap(self.pcap, 'google', workers=4, memory_budget=memory_budget))
+
+    def test_cached_frames_equal_decoded_ones(self):
+        serial = load_pcap(self.pcap, 'google')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertFramesEqual(serial, load_pcap(self.pcap, 'google', cache_dir, workers=4))
+            self.assertFramesEqual(serial, load_pcap(self.pcap, 'google', cache_dir))
+
+
+class EngineClassifierTest(unittest.TestCase):
+    def test_other_names_only_decide_without_lookups(self):
+        evidence = HostEvidence()
+        evidence.add('203.0.113.9', 'www.gstatic.com')
+        evidence.add('203.0.113.10', 'www.example.org')
+        self.assertFalse(EngineClassifier('google', evidence=evidence).is_engine('203.0.113.9'))
+
+        hostnames = {'203.0.113.9': 'ams16s01-in-f3.1e100.net', '203.0.113.10': 'example.org'}
+        classifier = EngineClassifier('google', ReverseDNSResolver(resolve_func=hostnames.get), evidence)
+        self.assertIsNone(classifier.classify('203.0.113.9'))
+        self.assertTrue(classifier.is_engine('203.0.113.9'))
+        self.assertFalse(classifier.is_engine('203.0.113.10'))
+
+
+if __name__ == '__main__':
+    unittest.main()
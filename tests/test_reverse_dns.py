@@ -0,0 +1,152 @@
+# ---------------------------------------------------------------
+# Encrypted Search Query Analysis By Eavesdropping (ESQABE)
+# Copyright (C) 2021  Isaac Meers (Hasselt University/EDM)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Please cite the paper if you are using this source code.
+# ---------------------------------------------------------------
+
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from esqabe import reverse_dns
+from esqabe.reverse_dns import ReverseDNSResolver
+
+
+class StubResolver:
+    """
+    resolve_func answering from names, other IPs fail. The first `slow` lookups take `hold` seconds (or until
+    release is set), the others `delay` seconds.
+    """
+    def __init__(self, names, slow=0, hold=0.0, delay=0.0):
+        self.names = names
+        self.slow = slow
+        self.hold = hold
+        self.delay = delay
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        # (ip, thread, slow)
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+
+    def __call__(self, ip):
+        with self.lock:
+            slow = len(self.calls) < self.slow
+            self.calls.append((ip, threading.get_ident(), slow))
+            if not slow:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+        try:
+            if slow:
+                self.release.wait(self.hold)
+            else:
+                time.sleep(self.delay)
+            if ip not in self.names:
+                raise socket.herror('unknown host')
+            return self.names[ip]
+        finally:
+            if not slow:
+                with self.lock:
+                    self.active -= 1
+
+    def looked_up(self):
+        with self.lock:
+            return [ip for ip, thread, slow in self.calls]
+
+
+class Clock:
+    """
+    time module of reverse_dns with a wall clock that only moves when told to
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return time.monotonic()
+
+
+class ReverseDNSResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.directory.name, 'reverse-dns.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_timed_out_lookup_fails_and_is_not_cached(self):
+        stub = StubResolver({'1.1.1.1': 'a.example', '3.3.3.3': 'c.example'}, slow=1, hold=5)
+        resolver = ReverseDNSResolver(self.cache_path, timeout=0.05, threads=2, resolve_func=stub)
+
+        start = time.monotonic()
+        names = resolver.resolve(['1.1.1.1', '2.2.2.2'])
+        self.assertLess(time.monotonic() - start, 1)
+        timed_out, answered = stub.looked_up()
+        self.assertEqual(names, {timed_out: None, answered: stub.names.get(answered)})
+        stub.release.set()
+
+        # Only the timed out IP is looked up again, the answered one is cached, also when the lookup failed
+        names = resolver.resolve(['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        self.assertEqual(names, {'1.1.1.1': 'a.example', '2.2.2.2': None, '3.3.3.3': 'c.example'})
+        self.assertEqual(sorted(stub.looked_up()[2:]), sorted([timed_out, '3.3.3.3']))
+
+    def test_cache_entries_expire_after_their_ttl(self):
+        clock = Clock()
+        stub = StubResolver({'1.1.1.1': 'a.example'})
+        with mock.patch.object(reverse_dns, 'time', clock):
+            resolver = ReverseDNSResolver(self.cache_path, resolve_func=stub, ttl=100, negative_ttl=10)
+            expected = {'1.1.1.1': 'a.example', '2.2.2.2': None}
+            self.assertEqual(resolver.resolve(['1.1.1.1', '2.2.2.2']), expected)
+
+            clock.now += 5
+            self.assertEqual(resolver.resolve(['1.1.1.1', '2.2.2.2']), expected)
+            self.assertEqual(len(stub.looked_up()), 2)
+
+            # Only the failed lookup is retried after the negative TTL, the host name after the TTL
+            clock.now += 10
+            self.assertEqual(resolver.resolve(['1.1.1.1', '2.2.2.2']), expected)
+            self.assertEqual(stub.looked_up()[2:], ['2.2.2.2'])
+
+            clock.now += 100
+            self.assertEqual(resolver.resolve(['1.1.1.1']), {'1.1.1.1': 'a.example'})
+            self.assertEqual(stub.looked_up()[3:], ['1.1.1.1'])
+
+    def test_abandoned_threads_take_no_new_ips(self):
+        ips = ['10.0.0.{}'.format(i) for i in range(32)]
+        stub = StubResolver({ip: 'host-{}.example'.format(ip) for ip in ips}, slow=2, hold=0.2, delay=0.02)
+        resolver = ReverseDNSResolver(timeout=0.05, threads=2, resolve_func=stub)
+
+        names = resolver.resolve(ips)
+        slow_ips = [ip for ip, thread, slow in stub.calls if slow]
+        self.assertEqual({ip for ip, name in names.items() if name is None}, set(slow_ips))
+        self.assertEqual(len(names), len(ips))
+
+        # The stuck threads return while IPs are still queued, they must not take any of them
+        time.sleep(0.3)
+        stuck = {thread for ip, thread, slow in stub.calls if slow}
+        self.assertEqual([ip for ip, thread, slow in stub.calls if thread in stuck and not slow], [])
+        self.assertLessEqual(stub.max_active, 2)
+        self.assertEqual(sorted(stub.looked_up()), sorted(ips))
+
+
+if __name__ == '__main__':
+    unittest.main()